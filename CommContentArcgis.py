@@ -0,0 +1,379 @@
+# CommContentArcgis.py
+#
+# ArcGIS stage: features built from the sheet rows, compared with the feature
+# layer and saved in batches, only imported when the layer is updated
+
+# Standard libraries
+import sys
+import math
+import base64
+import logging
+from functools import lru_cache
+
+# Libraries to be installed with pip
+import pandas
+from arcgis.gis import GIS
+
+# Default settings, can be overridden in the variable file
+ARCGIS_BATCH_SIZE = 250  # Maximum number of features sent in a single edit_features call
+ARCGIS_MAX_RETRIES = 3  # Number of times failed feature edits are submitted again
+ARCGIS_OBJECTID_FIELD = 'objectid'  # Object id field of the feature layer
+ARCGIS_FINGERPRINT_FIELD = 'fingerprint'  # Text field (32 characters) of the layer holding the row fingerprints
+ARCGIS_DIFF_BATCH_SIZE = 5000  # Sheet rows compared with the feature layer at once
+ARCGIS_QUERY_BATCH_SIZE = 500  # post_ids per query when only the changed features are read from the layer
+PROJECTION_METHOD = 'pyproj'  # 'pyproj' or 'spherical' for the pure math Web Mercator projection
+WEB_MERCATOR_RADIUS = 6378137.0  # WGS84 semi-major axis used by EPSG:3857
+
+# Variable file
+from CommContentProcessingVariables import *
+
+# Run instrumentation
+from CommContentMetrics import run_metrics
+
+# Retries and rate limits of the external services
+from CommContentRetry import call_service
+
+# Batches of rows
+from CommContentSheet import chunks
+
+
+@lru_cache(maxsize=None)
+def web_mercator_transformer():
+
+    # Transform longitude and latitude from WGS84 to Web Mercator
+    # EPSG:4326 -> WGS 84 -- WGS84 - World Geodetic System 1984
+    # EPSG:3857 -> WGS 84 / Pseudo-Mercator -- Spherical Mercator
+    # Building the transformer is the expensive part: done once for the process lifetime
+    # Imported here: pyproj is not needed by the 'spherical' projection
+    from pyproj import Transformer
+    return Transformer.from_crs('epsg:4326', 'epsg:3857', always_xy=True)
+
+
+def project_coordinates(longitudes, latitudes, method=PROJECTION_METHOD):
+
+    # Project whole lists of WGS84 coordinates to Web Mercator in one call
+    if method == 'spherical':
+        # Web Mercator is a spherical Mercator on the WGS84 semi-major axis
+        x_list = [WEB_MERCATOR_RADIUS * math.radians(longitude) for longitude in longitudes]
+        y_list = [WEB_MERCATOR_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(latitude) / 2))
+                  for latitude in latitudes]
+    else:
+        x_list, y_list = web_mercator_transformer().transform(longitudes, latitudes)
+
+    return [round(x, 2) for x in x_list], [round(y, 2) for y in y_list]
+
+
+def sheet_rows_to_features(records, fingerprint_field=None):
+
+    # Project the coordinates of all the geolocated records at once, then build the features
+    located = [idx for idx, record in enumerate(records) if record.is_located]
+
+    geometries = {}
+    if len(located) > 0:
+        x_list, y_list = project_coordinates([records[idx].longitude for idx in located],
+                                             [records[idx].latitude for idx in located])
+        geometries = dict(zip(located, zip(x_list, y_list)))
+
+    return [sheet_to_feature(record, geometries.get(idx), fingerprint_field) for idx, record in enumerate(records)]
+
+
+def sheet_to_feature(record, geometry=None, fingerprint_field=None):
+
+    # geometry: projected (x, y) of the record when already computed for a whole list of records
+    if record.is_located and geometry is None:
+        x_list, y_list = project_coordinates([record.longitude], [record.latitude])
+        geometry = x_list[0], y_list[0]
+
+    feature = record.to_feature(geometry or (0, 0))
+
+    # The fingerprint of the sheet row is saved with the feature when the layer has the field
+    if fingerprint_field is not None:
+        feature['attributes'][fingerprint_field] = record.fingerprint
+
+    return feature
+
+
+def diff_layer_features(layer_df, new_features):
+
+    # Compare the features built from the sheet with the features of the layer
+    # Both sides are indexed by post_id and compared column by column instead of row by row
+    if len(new_features) == 0:
+        return [], [], 0
+
+    new_df = pandas.DataFrame.from_records([feature['attributes'] for feature in new_features])
+    new_df['x'] = [feature['geometry']['x'] for feature in new_features]
+    new_df['y'] = [feature['geometry']['y'] for feature in new_features]
+    new_df = new_df[~new_df.post_id.duplicated()].set_index('post_id', drop=False)
+
+    features_by_id = {feature['attributes']['post_id']: feature for feature in new_features}
+
+    if len(layer_df) == 0:
+        for post_id in new_df.index:
+            logging.info('Adding post_id: %s' % post_id)
+        return [features_by_id[post_id] for post_id in new_df.index], [], 0
+
+    # A post_id duplicated in the layer is compared with its first feature
+    existing_df = layer_df[~layer_df.post_id.duplicated()].set_index('post_id', drop=False)
+
+    is_existing = new_df.index.isin(existing_df.index)
+    added_ids = new_df.index[~is_existing]
+    common_ids = new_df.index[is_existing]
+
+    new_common = new_df.loc[common_ids]
+    existing_common = existing_df.loc[common_ids]
+
+    # One boolean mask per attribute: True where the value changed
+    attributes = [attrib for attrib in existing_df.columns
+                  if attrib not in ['objectid', 'SHAPE', 'globalid', 'tag', 'x', 'y'] and attrib in new_df.columns]
+    changes = existing_common[attributes].ne(new_common[attributes])
+
+    # Geometry is compared on the coordinates rounded as in sheet_to_feature
+    existing_x = existing_common['SHAPE'].str['x'].astype(float).round(2)
+    existing_y = existing_common['SHAPE'].str['y'].astype(float).round(2)
+    changes['x'] = existing_x.ne(new_common['x'])
+    changes['y'] = existing_y.ne(new_common['y'])
+
+    changed = changes.any(axis=1)
+    changed_ids = common_ids[changed.to_numpy()]
+
+    features_to_add = []
+    for post_id in added_ids:
+        logging.info('Adding post_id: %s' % post_id)
+        features_to_add.append(features_by_id[post_id])
+
+    # Only the few changed rows are walked in Python, to build the edits and log the details
+    features_to_update = []
+    for post_id in changed_ids:
+        new_feature = features_by_id[post_id]
+        row_changes = changes.loc[post_id]
+
+        # Only the changed attributes are sent, the object id comes from the queried dataframe
+        edited_feature = {
+            'attributes': {
+                ARCGIS_OBJECTID_FIELD: int(existing_common.at[post_id, ARCGIS_OBJECTID_FIELD]),
+                'post_id': post_id
+            }
+        }
+
+        logging.info('Updating post_id: %s' % post_id)
+
+        for attrib in attributes:
+            if row_changes[attrib]:
+                edited_feature['attributes'][attrib] = new_feature['attributes'][attrib]
+                logging.info('new %s: %s' % (attrib, new_feature['attributes'][attrib]))
+                logging.info('existing %s: %s' % (attrib, existing_common.at[post_id, attrib]))
+
+        if row_changes['x']:
+            logging.info('new %s: %s' % ('x', new_feature['geometry']['x']))
+            logging.info('exist %s: %s' % ('x', existing_x[post_id]))
+
+        if row_changes['y']:
+            logging.info('new %s: %s' % ('y', new_feature['geometry']['y']))
+            logging.info('exist %s: %s' % ('y', existing_y[post_id]))
+
+        if row_changes['x'] or row_changes['y']:
+            edited_feature['geometry'] = new_feature['geometry']
+
+        features_to_update.append(edited_feature)
+
+    counter_unchanged = len(common_ids) - len(changed_ids)
+
+    return features_to_add, features_to_update, counter_unchanged
+
+
+def edit_layer_features(flayer, operation, features, batch_size=ARCGIS_BATCH_SIZE, max_retries=ARCGIS_MAX_RETRIES):
+
+    # operation is the edit_features argument: 'adds' or 'updates'
+    result_key = {'adds': 'addResults', 'updates': 'updateResults'}[operation]
+
+    counter_succeeded = 0
+    pending_features = features
+    # Adds whose call failed may have been saved: they are not sent again by this run, the next run
+    # queries the layer for their post_id and adds or updates them
+    unknown_features = []
+    attempt = 0
+
+    while len(pending_features) > 0 and attempt <= max_retries:
+
+        if attempt > 0:
+            logging.info('Retrying %s failed %s' % (len(pending_features), operation))
+            run_metrics().record_retry('ArcGIS', len(pending_features))
+
+        failed_features = []
+
+        for batch in chunks(pending_features, batch_size):
+            # Transient errors are retried with backoff, adds only when refused for rate limiting
+            # as a timed out add may have been saved
+            try:
+                result = call_service('ArcGIS', flayer.edit_features, idempotent=(operation == 'updates'),
+                                      **{operation: batch})
+            except Exception as error:
+                logging.error('Error on %s of %s features: %s' % (operation, len(batch), error))
+                print('Error on %s of %s features' % (operation, len(batch)), error)
+                if operation == 'adds':
+                    unknown_features.extend(batch)
+                else:
+                    failed_features.extend(batch)
+                continue
+
+            # One result per submitted feature, in the same order
+            for feature, feature_result in zip(batch, result[result_key]):
+                if feature_result['success']:
+                    counter_succeeded = counter_succeeded + 1
+                else:
+                    logging.error('Feature post_id %s failed on %s: %s'
+                                  % (feature['attributes']['post_id'], operation, feature_result.get('error')))
+                    failed_features.append(feature)
+
+        pending_features = failed_features
+        attempt = attempt + 1
+
+    for feature in pending_features:
+        logging.error('Feature post_id %s could not be saved after %s attempts'
+                      % (feature['attributes']['post_id'], attempt))
+    for feature in unknown_features:
+        logging.error('Feature post_id %s may not have been added, left for the next run'
+                      % feature['attributes']['post_id'])
+
+    # Features still failing are given back to be sent again by the next run
+    return counter_succeeded, pending_features + unknown_features
+
+
+def query_layer_features(flayer, post_ids=None, batch_size=ARCGIS_QUERY_BATCH_SIZE):
+
+    # Features of the layer as a dataframe: all of them, or only those of the given post_ids
+    if post_ids is None:
+        return call_service('ArcGIS', flayer.query).df
+
+    frames = []
+    for batch in chunks(sorted(post_ids), batch_size):
+        # Quotes are doubled in SQL string literals
+        where = 'post_id IN (%s)' % ','.join("'%s'" % post_id.replace("'", "''") for post_id in batch)
+        frames.append(call_service('ArcGIS', flayer.query, where=where).df)
+
+    if len(frames) == 0:
+        return pandas.DataFrame(columns=['post_id'])
+
+    return pandas.concat(frames, ignore_index=True)
+
+
+def layer_field_names(flayer):
+    return [field['name'] for field in flayer.properties.fields]
+
+
+def query_layer_fingerprints(flayer, fingerprint_field=ARCGIS_FINGERPRINT_FIELD):
+
+    # post_id -> fingerprint of every feature of the layer, without the geometries nor the other attributes
+    layer_df = call_service('ArcGIS', flayer.query, out_fields='post_id,%s' % fingerprint_field,
+                            return_geometry=False).df
+
+    if len(layer_df) == 0:
+        return {}
+
+    # A post_id duplicated in the layer is compared with its first feature, as in diff_layer_features
+    layer_df = layer_df[~layer_df.post_id.duplicated()]
+    return dict(zip(layer_df.post_id, layer_df[fingerprint_field]))
+
+
+def update_arcgis_layer(sheet_index, store, full_verification=False, compare_fingerprints=True):
+
+    # Bring the feature layer up to date with the sheet, returns the post_ids that could not be saved
+    # full_verification compares the whole sheet with the whole layer, otherwise only the rows
+    # the content store has not seen saved in the layer
+    # The rows found equal in the layer or saved in it are marked in the store as they go,
+    # so that a run that stops halfway does not send them again
+    # With compare_fingerprints, the full verification only compares every attribute of the rows
+    # whose fingerprint differs from the one saved in the layer
+
+    # Connect to Portal
+    arcgis_password = base64.b64decode(ARCGIS_PASSWORD).decode("utf-8")
+
+    try:
+        gis = call_service('ArcGIS', GIS, ARCGIS_PORTAL, ARCGIS_USER, arcgis_password)
+    except RuntimeError as error:
+        logging.error(f'CANNOT CONNECT TO PORTAL: {error}')  # Add exc_info = 1 to log full error
+        print('CANNOT CONNECT TO PORTAL', error)
+        sys.exit()
+    logging.info('### Connected to ArcGIS Portal')
+
+    # Search for the feature layer by name
+    # search_query = 'title:' + ARCGIS_FEATURE_LAYER
+    # search_result = gis.content.search(search_query)
+    # online_content_item = search_result[0]
+
+    # Search for the feature layer by ID
+    online_content_item = call_service('ArcGIS', gis.content.get, ARCGIS_ITEM_ID)
+
+    # Access the item's feature layers
+
+    online_content_layers = online_content_item.layers
+    online_content_flayer = online_content_layers[0]
+
+    # Layers created before the fingerprints were introduced are compared attribute by attribute
+    if ARCGIS_FINGERPRINT_FIELD is not None and ARCGIS_FINGERPRINT_FIELD in layer_field_names(online_content_flayer):
+        fingerprint_field = ARCGIS_FINGERPRINT_FIELD
+    else:
+        fingerprint_field = None
+
+    counter_matched = 0
+
+    if full_verification and compare_fingerprints and fingerprint_field is not None:
+        logging.info('### Full verification of the feature layer fingerprints')
+        layer_fingerprints = query_layer_fingerprints(online_content_flayer, fingerprint_field)
+        records = []
+        matched_records = []
+        for record in sheet_index.records():
+            if layer_fingerprints.get(record.post_id) == record.fingerprint:
+                matched_records.append(record)
+            else:
+                records.append(record)
+        counter_matched = len(matched_records)
+        store.mark_layer_synced(matched_records)
+        layer_df = query_layer_features(online_content_flayer,
+                                        [record.post_id for record in records if record.post_id in layer_fingerprints])
+    elif full_verification:
+        logging.info('### Full verification of the feature layer')
+        records = sheet_index.records()
+        layer_df = query_layer_features(online_content_flayer)
+    else:
+        records = sheet_index.records(sorted(store.layer_pending()))
+        layer_df = query_layer_features(online_content_flayer, [record.post_id for record in records])
+    logging.info('### %s sheet rows to compare with the feature layer' % len(records))
+
+    # Rows with the same fingerprint as their feature are unchanged
+    counter_processed = counter_matched
+    counter_added = 0
+    counter_updated = 0
+    counter_unchanged = counter_matched
+    counter_failed = 0
+    failed_post_ids = set()
+
+    # The sheet rows are turned into features, compared and sent batch by batch
+    for batch in chunks(records, ARCGIS_DIFF_BATCH_SIZE):
+        new_features = sheet_rows_to_features(batch, fingerprint_field)
+
+        features_to_add, features_to_update, batch_unchanged = diff_layer_features(layer_df, new_features)
+
+        batch_added, batch_add_failed = edit_layer_features(online_content_flayer, 'adds', features_to_add)
+        batch_updated, batch_update_failed = edit_layer_features(online_content_flayer, 'updates', features_to_update)
+
+        counter_processed = counter_processed + len(new_features)
+        counter_added = counter_added + batch_added
+        counter_updated = counter_updated + batch_updated
+        counter_unchanged = counter_unchanged + batch_unchanged
+        counter_failed = counter_failed + len(batch_add_failed) + len(batch_update_failed)
+
+        for feature in batch_add_failed + batch_update_failed:
+            failed_post_ids.add(feature['attributes']['post_id'])
+
+        store.mark_layer_synced([record for record in batch if record.post_id not in failed_post_ids])
+
+    logging.info('Processed: %s, Added: %s, Updated: %s, Unchanged: %s, Failed: %s'
+                 % (counter_processed, counter_added, counter_updated, counter_unchanged, counter_failed))
+    print('Processed: %s, Added: %s, Updated: %s, Unchanged: %s, Failed: %s'
+          % (counter_processed, counter_added, counter_updated, counter_unchanged, counter_failed))
+
+    run_metrics().add_counters('ArcGIS update', processed=counter_processed, added=counter_added,
+                               updated=counter_updated, unchanged=counter_unchanged, failed=counter_failed)
+
+    return failed_post_ids
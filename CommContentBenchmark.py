@@ -0,0 +1,906 @@
+# CommContentBenchmark.py
+#
+# Offline benchmark of the content processing: synthetic posts, sheet rows and
+# layer features at increasing sizes, run against in-process stand-ins for
+# Google Sheets, the YouTube/Blogger discovery clients, the Wordpress REST API
+# and the ArcGIS feature layer
+#
+# python CommContentBenchmark.py --sizes 1000 10000 50000 --output benchmark.json
+# python CommContentBenchmark.py --posts 100 1000 10000 --rows 50000 --features 50000 to scale the stages apart
+# python CommContentBenchmark.py --import-budget to check the start-up time of CommContentProcessing
+
+# Standard libraries
+import os
+import sys
+import re
+import csv
+import json
+import time
+import logging
+import types
+import random
+import atexit
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Libraries to be installed with pip
+import pandas
+
+# Benchmark settings, installed as the variable file: the benchmark never reads
+# the production settings nor talks to the production services
+BENCHMARK_DIR = tempfile.mkdtemp(prefix='commcontent-benchmark-')
+atexit.register(shutil.rmtree, BENCHMARK_DIR, ignore_errors=True)
+
+benchmark_variables = types.ModuleType('CommContentProcessingVariables')
+benchmark_variables.__dict__.update({
+    'ONLINE_CONTENT_SPREADSHEET_ID': 'benchmark',
+    'ONLINE_CONTENT_RANGE_NAME': 'Content!A3:M',
+    'ONLINE_CONTENT_UPDATE_RANGE': 'Content!A%s:M%s',
+    'ONLINE_CONTENT_FIRST_POST_ROW': 3,
+    'ONLINE_CONTENT_SORT_START_ROW_INDEX': 2,
+    'ONLINE_CONTENT_SORT_START_COLUMN_INDEX': 0,
+    'ONLINE_CONTENT_SORT_END_COLUMN_INDEX': 13,
+    'ONLINE_CONTENT_SORT_COLUMN': 2,
+    'ONLINE_CONTENT_LATITUDE_ROW': 11,
+    'ONLINE_CONTENT_LONGITUDE_ROW': 12,
+    'WORDPRESS_LOCATION_PROVIDER': 'file',
+    'WORDPRESS_LOCATION_CSV': os.path.join(BENCHMARK_DIR, 'locations.csv'),
+    'WORDPRESS_LOCATION_INDEX': os.path.join(BENCHMARK_DIR, 'locations.idx'),
+    'HTTP_CACHE_DIR': os.path.join(BENCHMARK_DIR, 'http-cache'),
+    'RUN_REPORT_FILE': os.path.join(BENCHMARK_DIR, 'run-report.json'),
+    # The local stand-ins have no quota: rate limits would be measured instead of the processing
+    'SERVICE_RATE_LIMITS': {}
+})
+sys.modules['CommContentProcessingVariables'] = benchmark_variables
+
+# Modules benchmarked, imported once the benchmark settings are in place
+from CommContentSources import process_tchop, process_youtube, process_blogger, process_wordpress, \
+    harvest_sources, stream_rows
+from CommContentSheet import SheetIndex, load_sheet_index, update_google_sheet
+from CommContentArcgis import sheet_rows_to_features, diff_layer_features, query_layer_features, edit_layer_features, \
+    query_layer_fingerprints
+from CommContentRecord import ContentRecord
+import CommContentHtml
+from CommContentHtml import summarize_html
+from CommContentJournal import RunJournal
+from CommContentStore import ContentStore
+
+SOURCES = ['Tchop', 'YouTube', 'Blogger', 'Wordpress']
+
+# Start-up of the entry point: seconds allowed to import CommContentProcessing,
+# and libraries it must leave to the stages that need them
+IMPORT_TIME_BUDGET = 0.5
+HEAVY_MODULES = ['arcgis', 'pandas', 'pyproj', 'selenium', 'bs4', 'lxml', 'googleapiclient', 'requests']
+
+# Run in a fresh interpreter, with an empty variable file
+IMPORT_CHECK = '''
+import sys, json, time, types
+sys.modules['CommContentProcessingVariables'] = types.ModuleType('CommContentProcessingVariables')
+start = time.perf_counter()
+import CommContentProcessing
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'modules': sorted(set(name.split('.')[0] for name in sys.modules))}))
+'''
+
+PARAGRAPH = ('Children in Malawi took part in the campaign with their teachers and parents. '
+             'The programme reached schools in every district of the region. ')
+
+# Post bodies where the HTML extraction backends could disagree on whitespace
+HTML_SAMPLES = [
+    '<p>Before</p><pre>  code  \n <b> bold </b>\n\n tail inside pre  </pre>\n\n   <p>After</p>',
+    '<div><pre>code</pre>   \n   tail after pre</div>',
+    '<pre><b>bold</b>   \n   </pre>   \n  ',
+    '<textarea>  text  </textarea>\n \n<span>span</span>  \n ',
+    '<div>\n  <p>Text <a href="https://example.org/">link</a></p>\n  <script>var x;</script>\n</div>'
+]
+
+
+######################
+# Synthetic data     #
+######################
+
+def synthetic_date(rng):
+    return '20%02d-%02d-%02dT%02d:%02d:%02d' % (rng.randint(12, 25), rng.randint(1, 12), rng.randint(1, 28),
+                                                 rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59))
+
+
+def synthetic_location(rng):
+    # About two posts out of three are geolocated in Malawi
+    if rng.random() < 0.33:
+        return 0, 0
+    return rng.uniform(-17.1, -9.4), rng.uniform(32.7, 35.9)
+
+
+def synthetic_html(rng, paragraphs=8):
+    # Post body with links, an image and an embedded video somewhere in the text
+    parts = ['<div class="post">']
+    for idx in range(paragraphs):
+        parts.append('<p>%s<a href="https://example.org/%s">link</a></p>' % (PARAGRAPH * rng.randint(1, 3), idx))
+        if idx == paragraphs // 2:
+            parts.append('<img src="https://example.org/image-%s.jpg"/>' % rng.randint(0, 10 ** 6))
+            parts.append('<iframe src="https://www.youtube.com/embed/%s"></iframe>' % rng.randint(0, 10 ** 6))
+    parts.append('</div>')
+    return ''.join(parts)
+
+
+def synthetic_records(count, seed=0, first_id=0):
+
+    # Content records as the collectors produce them, spread over the four sources
+    rng = random.Random(seed)
+    records = []
+
+    for idx in range(first_id, first_id + count):
+        source = SOURCES[idx % len(SOURCES)]
+        if source == 'YouTube':
+            latitude = None
+            longitude = None
+        else:
+            latitude, longitude = synthetic_location(rng)
+
+        records.append(ContentRecord(
+            '%s Download Script' % source,
+            '%s-%s' % (source.lower(), idx),
+            synthetic_date(rng),
+            'https://example.org/post/%s' % idx,
+            'Title of post %s' % idx,
+            PARAGRAPH[:150] + '...',
+            'https://example.org/image-%s.jpg' % idx,
+            '',
+            'https://example.org/thumb-%s.jpg' % idx,
+            'photo',
+            source,
+            latitude=latitude,
+            longitude=longitude
+        ))
+
+    return records
+
+
+def changed_records(records, ratio, seed=0):
+
+    # Copy of the records with the title of a share of them changed
+    rng = random.Random(seed)
+    changed = []
+
+    for record in records:
+        if rng.random() < ratio:
+            values = list(record.text_values())
+            values[4] = values[4] + ' (edited)'
+            record = ContentRecord(*values, latitude=record.latitude, longitude=record.longitude)
+        changed.append(record)
+
+    return changed
+
+
+def tchop_dump(count, seed=0):
+
+    rng = random.Random(seed)
+    cards = []
+    for idx in range(count):
+        latitude, longitude = synthetic_location(rng)
+        cards.append({
+            'id': idx,
+            'type': 'image',
+            'postedTime': synthetic_date(rng) + '.000Z',
+            'title': 'Title of card %s' % idx,
+            'headline': 'Headline of card %s' % idx,
+            'text': PARAGRAPH,
+            'image': {
+                'phone': {'jpg': 'https://example.org/card-%s.jpg' % idx},
+                'exif': {'gps': {'latitude': latitude, 'longitude': longitude}} if latitude != 0 else {}
+            }
+        })
+
+    # Cards are grouped in mixes of 50
+    return [{'cards': cards[start:start + 50]} for start in range(0, count, 50)]
+
+
+def youtube_videos(count, seed=0):
+
+    # Video resources of the channel, most recent first as in the uploads playlist
+    rng = random.Random(seed)
+    videos = [{
+        'id': 'video-%s' % idx,
+        'snippet': {
+            'title': 'Video %s' % idx,
+            'description': PARAGRAPH,
+            'publishedAt': synthetic_date(rng) + 'Z',
+            'thumbnails': {'medium': {'url': 'https://example.org/video-%s.jpg' % idx}}
+        },
+        'status': {'privacyStatus': 'public'}
+    } for idx in range(count)]
+    return sorted(videos, key=lambda video: video['snippet']['publishedAt'], reverse=True)
+
+
+def blogger_posts(count, seed=0):
+
+    rng = random.Random(seed)
+    posts = []
+    for idx in range(count):
+        published = synthetic_date(rng) + '+02:00'
+        post = {
+            'id': 'blogger-%s' % idx,
+            'published': published,
+            'updated': published,
+            'url': 'https://example.blogspot.com/%s.html' % idx,
+            'title': 'Blog post %s' % idx,
+            'content': synthetic_html(rng)
+        }
+        latitude, longitude = synthetic_location(rng)
+        if latitude != 0:
+            post['location'] = {'lat': latitude, 'lng': longitude}
+        posts.append(post)
+    return posts
+
+
+def wordpress_posts(count, seed=0):
+
+    rng = random.Random(seed)
+    posts = []
+    for idx in range(count):
+        date = synthetic_date(rng)
+        posts.append({
+            'id': idx + 1,
+            'date': date,
+            'modified': date,
+            'link': 'https://example.org/?p=%s' % (idx + 1),
+            'title': {'rendered': 'Wordpress post %s' % idx},
+            'excerpt': {'rendered': '<p>%s</p>' % PARAGRAPH},
+            'content': {'rendered': synthetic_html(rng)}
+        })
+    return posts
+
+
+def write_location_csv(posts, csv_file, seed=0):
+
+    # Same columns as the GEO my WP export: 2 -> post_id, 9 -> latitude, 10 -> longitude
+    rng = random.Random(seed)
+    with open(csv_file, 'w', newline='') as location_csv:
+        writer = csv.writer(location_csv)
+        writer.writerow(['column %s' % idx for idx in range(11)])
+        for post in posts:
+            latitude, longitude = synthetic_location(rng)
+            if latitude != 0:
+                writer.writerow(['', '', post['id'], '', '', '', '', '', '', latitude, longitude])
+
+
+######################
+# Fake services      #
+######################
+
+class FakeRequest:
+
+    # Google API client request: the response is computed when executed
+
+    def __init__(self, response, **parameters):
+        self.response = response
+        self.parameters = parameters
+
+    def execute(self):
+        return self.response(**self.parameters)
+
+
+class FakeSheets:
+
+    # spreadsheets() of the Sheets API on an in-memory table of rows
+
+    def __init__(self, rows):
+        self.rows = [list(row) for row in rows]
+        self.calls = 0
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def row_position(self, cell_range):
+        # 'Content!A12:M12' -> position of row 12 in the table
+        row = int(cell_range.split('!A')[1].split(':')[0])
+        return row - benchmark_variables.ONLINE_CONTENT_FIRST_POST_ROW
+
+    def get(self, spreadsheetId, range):
+        def response():
+            self.calls = self.calls + 1
+            # Only the post_id column, e.g. 'Content!B3:B'
+            if '!B' in range:
+                return {'values': [row[1:2] for row in self.rows]}
+            return {'values': [list(row) for row in self.rows]}
+        return FakeRequest(response)
+
+    def append(self, spreadsheetId, range, valueInputOption, insertDataOption, body):
+        def response():
+            self.calls = self.calls + 1
+            self.rows.extend(body['values'])
+            return {}
+        return FakeRequest(response)
+
+    def batchUpdate(self, spreadsheetId, body):
+        def response():
+            self.calls = self.calls + 1
+            # values().batchUpdate
+            for value_range in body.get('data', []):
+                self.rows[self.row_position(value_range['range'])] = value_range['values'][0]
+            # spreadsheets().batchUpdate
+            for request in body.get('requests', []):
+                if 'sortRange' in request:
+                    self.rows.sort(key=lambda row: row[benchmark_variables.ONLINE_CONTENT_SORT_COLUMN])
+                elif 'insertDimension' in request:
+                    dimension_range = request['insertDimension']['range']
+                    position = dimension_range['startIndex'] - benchmark_variables.ONLINE_CONTENT_SORT_START_ROW_INDEX
+                    self.rows[position:position] = [[] for idx in range(dimension_range['endIndex'] -
+                                                                         dimension_range['startIndex'])]
+            return {'totalUpdatedRows': len(body.get('data', []))}
+        return FakeRequest(response)
+
+
+class FakeListResource:
+
+    # Resource of a discovery client with list()/list_next() pagination over a list of items
+
+    def __init__(self, items, page_size=50):
+        self.items = items
+        self.page_size = page_size
+
+    def page(self, pageToken=None, **parameters):
+        start = int(pageToken or 0)
+        response = {'items': self.items[start:start + self.page_size]}
+        if start + self.page_size < len(self.items):
+            response['nextPageToken'] = str(start + self.page_size)
+        return response
+
+    def list(self, **parameters):
+        return FakeRequest(self.page, **parameters)
+
+    def list_next(self, previous_request, previous_response):
+        if 'nextPageToken' not in previous_response:
+            return None
+        return FakeRequest(self.page, **dict(previous_request.parameters, pageToken=previous_response['nextPageToken']))
+
+
+class FakeYouTube:
+
+    # channels(), playlistItems() and videos() of the YouTube API on a list of video resources
+
+    def __init__(self, videos):
+        self.videos_by_id = {video['id']: video for video in videos}
+        self.playlist_items = FakeListResource([{
+            'contentDetails': {'videoId': video['id'], 'videoPublishedAt': video['snippet']['publishedAt']}
+        } for video in videos])
+
+    def channel(self, part, id):
+        return {'items': [{'contentDetails': {'relatedPlaylists': {'uploads': 'uploads-%s' % id}}}]}
+
+    def video_details(self, part, id):
+        return {'items': [self.videos_by_id[video_id] for video_id in id.split(',')]}
+
+    def channels(self):
+        return types.SimpleNamespace(list=lambda **parameters: FakeRequest(self.channel, **parameters))
+
+    def playlistItems(self):
+        return self.playlist_items
+
+    def videos(self):
+        return types.SimpleNamespace(list=lambda **parameters: FakeRequest(self.video_details, **parameters))
+
+
+class FakeBlogger:
+
+    def __init__(self, posts):
+        self.resource = FakeListResource(posts)
+
+    def posts(self):
+        return self.resource
+
+
+class FakeWordpressServer:
+
+    # Wordpress REST API posts endpoint served over HTTP on localhost,
+    # so that the benchmark goes through the real requests session
+
+    def __init__(self, posts):
+        posts_json = posts
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                page = int(query.get('page', ['1'])[0])
+                per_page = int(query.get('per_page', ['10'])[0])
+                total_pages = max(1, -(-len(posts_json) // per_page))
+
+                if page > total_pages:
+                    body = json.dumps({'code': 'rest_post_invalid_page_number'}).encode('utf-8')
+                    self.send_response(400)
+                else:
+                    body = json.dumps(posts_json[(page - 1) * per_page:page * per_page]).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('X-WP-Total', str(len(posts_json)))
+                    self.send_header('X-WP-TotalPages', str(total_pages))
+
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return 'http://127.0.0.1:%s/wp-json/wp/v2/posts' % self.server.server_address[1]
+
+    def __exit__(self, *error):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeQueryResult:
+
+    def __init__(self, df):
+        self.df = df
+
+
+class FakeFeatureLayer:
+
+    # Feature layer with properties.fields, query(where=..., out_fields=...).df and edit_features(adds/updates)
+
+    def __init__(self, features):
+        self.features = {}
+        for feature in features:
+            self.add(feature)
+
+        field_names = ['objectid'] + (list(features[0]['attributes']) if len(features) > 0 else [])
+        self.properties = types.SimpleNamespace(fields=[{'name': name} for name in field_names])
+
+    def add(self, feature):
+        objectid = len(self.features) + 1
+        self.features[objectid] = {
+            'attributes': dict(feature['attributes'], objectid=objectid),
+            'geometry': dict(feature['geometry'])
+        }
+
+    def query(self, where='1=1', out_fields='*', return_geometry=True):
+        features = self.features.values()
+        if where.startswith('post_id IN ('):
+            # Quoted post_ids, quotes doubled inside
+            post_ids = set(post_id.replace("''", "'") for post_id in re.findall("'((?:[^']|'')*)'", where))
+            features = [feature for feature in features if feature['attributes']['post_id'] in post_ids]
+
+        records = []
+        for feature in features:
+            if out_fields == '*':
+                record = dict(feature['attributes'])
+            else:
+                record = {field: feature['attributes'].get(field) for field in ['objectid'] + out_fields.split(',')}
+            if return_geometry:
+                record['SHAPE'] = dict(feature['geometry'], spatialReference={'wkid': 102100})
+            records.append(record)
+
+        return FakeQueryResult(pandas.DataFrame.from_records(records))
+
+    def edit_features(self, adds=None, updates=None):
+        results = []
+        for feature in adds or []:
+            self.add(feature)
+            results.append({'success': True})
+        for feature in updates or []:
+            stored = self.features[feature['attributes']['objectid']]
+            stored['attributes'].update(feature['attributes'])
+            if 'geometry' in feature:
+                stored['geometry'] = dict(feature['geometry'])
+            results.append({'success': True})
+
+        return {'addResults': results} if adds is not None else {'updateResults': results}
+
+
+######################
+# Benchmarks         #
+######################
+
+def timed(function, repeat):
+
+    # Best wall time of repeat runs, with the result of the last run
+    best = None
+    for run in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def consume(batches):
+    return sum(len(batch) for batch in batches)
+
+
+def collect(batches):
+    return [row for batch in batches for row in batch]
+
+
+def normalize_pool(workers=2):
+
+    # Worker processes normalizing the posts, forked so that they inherit the benchmark settings
+    # None where processes cannot be forked, e.g. on Windows
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+
+
+def pooled_mismatches(pool, size):
+
+    # Sources normalized by the worker processes, with more chunks than NORMALIZE_MAX_PENDING,
+    # whose rows differ from those normalized in the collector thread
+    dump = tchop_dump(size)
+    blogger = FakeBlogger(blogger_posts(size))
+
+    mismatches = []
+    if collect(process_tchop(dump, pool)) != collect(process_tchop(dump)):
+        mismatches.append('Tchop')
+    if collect(process_blogger(blogger, 'blog', pool=pool)) != collect(process_blogger(blogger, 'blog')):
+        mismatches.append('Blogger')
+
+    return mismatches
+
+
+def benchmark_size(posts, rows, features, repeat, change_ratio=0.05, new_ratio=0.05):
+
+    # posts harvested per source, rows already in the sheet and features already in the layer
+    # Returns {benchmark: (seconds, items)}, items being the size that drives the benchmark
+    results = {}
+
+    # Normalizers, fed by the fake discovery clients and the fake Wordpress API
+    dump = tchop_dump(posts)
+    results['process_tchop'] = timed(lambda: consume(process_tchop(dump)), repeat)
+
+    youtube = FakeYouTube(youtube_videos(posts))
+    results['process_youtube'] = timed(lambda: consume(process_youtube(youtube, 'channel')), repeat)
+
+    blogger = FakeBlogger(blogger_posts(posts))
+    results['process_blogger'] = timed(lambda: consume(process_blogger(blogger, 'blog')), repeat)
+
+    # Same normalizers spread over worker processes, as with --normalize-workers
+    pool = normalize_pool()
+    if pool is not None:
+        with pool:
+            results['process_tchop_pool'] = timed(lambda: collect(process_tchop(dump, pool)), repeat)
+            results['process_blogger_pool'] = timed(lambda: collect(process_blogger(blogger, 'blog', pool=pool)),
+                                                    repeat)
+            mismatches = pooled_mismatches(pool, posts)
+        if len(mismatches) > 0:
+            raise RuntimeError('%s rows normalized by the worker processes differ from the collector thread'
+                               % ', '.join(mismatches))
+
+    wordpress = wordpress_posts(posts)
+    write_location_csv(wordpress, benchmark_variables.WORDPRESS_LOCATION_CSV)
+    with FakeWordpressServer(wordpress) as wordpress_url:
+        results['process_wordpress'] = timed(lambda: consume(process_wordpress(wordpress_url)), repeat)
+
+    # Sheet update: posts harvested over the rows of the sheet, mostly rows already there
+    # with some of them changed, and some new posts
+    sheet_records = synthetic_records(rows)
+    sheet_rows = [record.to_row() for record in sheet_records]
+    new_count = max(1, int(posts * new_ratio))
+    harvested = changed_records(sheet_records[max(0, rows - (posts - new_count)):], change_ratio) + \
+        synthetic_records(new_count, seed=1, first_id=rows)
+
+    def update_sheet():
+        sheet = FakeSheets(sheet_rows)
+        return update_google_sheet(sheet, SheetIndex(sheet.rows), harvested)
+
+    results['update_google_sheet'] = timed(update_sheet, repeat)
+
+    # Features of the whole sheet
+    results['sheet_rows_to_features'] = timed(lambda: sheet_rows_to_features(sheet_records), repeat)
+    sheet_features = results['sheet_rows_to_features'][1]
+
+    # Layer diff against a layer where a share of the features changed
+    # The first rows of the sheet and the first features of the layer are the same posts
+    layer_features = sheet_rows_to_features(changed_records(synthetic_records(features), change_ratio, seed=2),
+                                            'fingerprint')
+    fingerprint_layer = FakeFeatureLayer(layer_features)
+    layer_df = fingerprint_layer.query().df
+    results['diff_layer_features'] = timed(lambda: diff_layer_features(layer_df, sheet_features), repeat)
+
+    # Same comparison on the fingerprints, with the attribute diff of the mismatches only
+    def diff_fingerprints():
+        layer_fingerprints = query_layer_fingerprints(fingerprint_layer, 'fingerprint')
+        mismatches = [record for record in sheet_records
+                      if layer_fingerprints.get(record.post_id) != record.fingerprint]
+        mismatch_df = layer_df[layer_df.post_id.isin([record.post_id for record in mismatches])]
+        return diff_layer_features(mismatch_df, sheet_rows_to_features(mismatches, 'fingerprint'))
+
+    results['diff_layer_fingerprints'] = timed(diff_fingerprints, repeat)
+
+    # Query and edits of the changed features on the fake layer
+    def sync_layer():
+        flayer = FakeFeatureLayer(layer_features)
+        changed_ids = [feature['attributes']['post_id']
+                       for feature in sheet_features[:int(min(rows, features) * change_ratio) + 1]]
+        features_to_add, features_to_update, unchanged = diff_layer_features(
+            query_layer_features(flayer, changed_ids), sheet_features[:len(changed_ids)])
+        return edit_layer_features(flayer, 'updates', features_to_update)
+
+    results['arcgis_sync'] = timed(sync_layer, repeat)
+
+    items = {'update_google_sheet': rows, 'sheet_rows_to_features': rows, 'diff_layer_features': features,
+             'diff_layer_fingerprints': features, 'arcgis_sync': features}
+
+    return {name: (seconds, items.get(name, posts)) for name, (seconds, result) in results.items()}
+
+
+def check_resume(size=200):
+
+    # Run stopped between the append of the new rows and the update of the changed ones, then resumed:
+    # no row may be appended twice, and the rows pending for the layer are the new and changed ones
+    # Returns the failures, none when the check passes
+    journal_file = os.path.join(BENCHMARK_DIR, 'checkpoint.sqlite')
+    store_file = os.path.join(BENCHMARK_DIR, 'content.sqlite')
+
+    sheet_records = synthetic_records(size)
+    changed = [record for record, previous in zip(changed_records(sheet_records, 0.1, seed=3), sheet_records)
+               if record.title != previous.title]
+    new = synthetic_records(size // 10, seed=1, first_id=size)
+
+    class StoppingSheets(FakeSheets):
+
+        # The run stops on the first update, once the new rows were appended
+
+        def batchUpdate(self, spreadsheetId, body):
+            raise RuntimeError('Run stopped')
+
+    def sheet_stage(sheet):
+
+        # Sheet stage of main() with a single source harvesting the new and changed rows
+        journal = RunJournal(journal_file)
+        journal.start_run({'full_resync': False, 'verify_layer': False})
+        store = ContentStore(store_file)
+        try:
+            sheet_index = load_sheet_index(sheet, store)
+            if journal.source_done('Tchop'):
+                collectors = [('Tchop', partial(journal.replay_source, 'Tchop'))]
+                replayed_sources = ['Tchop']
+            else:
+                journal.discard_source('Tchop')
+                collectors = [('Tchop', lambda: iter([changed + new]))]
+                replayed_sources = []
+
+            completed_sources = []
+            store.begin_sheet_changes()
+            update_google_sheet(sheet, sheet_index, stream_rows(harvest_sources(collectors, completed_sources), {},
+                                                                journal, completed_sources, replayed_sources))
+            store.save_sheet(sheet_index, sheet_index.dirty)
+            journal.complete_stage('Google Sheet update')
+            journal.finish_run()
+
+            return journal.resumed, store.layer_pending()
+        finally:
+            store.close()
+            journal.close()
+
+    # Previous run: the store, the sheet and the layer hold the same rows
+    sheet = FakeSheets([record.to_row() for record in sheet_records])
+    store = ContentStore(store_file)
+    store.mark_layer_synced(load_sheet_index(sheet, store).records())
+    store.close()
+
+    stopped_sheet = StoppingSheets(sheet.rows)
+    try:
+        sheet_stage(stopped_sheet)
+        failures = ['the run did not stop']
+    except RuntimeError:
+        failures = []
+
+    sheet = FakeSheets(stopped_sheet.rows)
+    resumed, layer_pending = sheet_stage(sheet)
+    post_ids = [row[1] for row in sheet.rows]
+    titles = dict((row[1], row[4]) for row in sheet.rows)
+
+    if not resumed:
+        failures.append('the run was not resumed')
+    if len(post_ids) != len(set(post_ids)):
+        failures.append('%s rows appended twice' % (len(post_ids) - len(set(post_ids))))
+    if set(post_ids) != set(record.post_id for record in sheet_records + new):
+        failures.append('rows missing from the sheet')
+    if any(titles[record.post_id] != record.title for record in changed):
+        failures.append('changed rows not updated')
+    if layer_pending != set(record.post_id for record in changed + new):
+        failures.append('%s rows pending for the layer instead of %s' % (len(layer_pending), len(changed + new)))
+
+    # Next run: only the post_id column is read, the rows are loaded from the store
+    calls = sheet.calls
+    store = ContentStore(store_file)
+    if len(load_sheet_index(sheet, store)) != len(post_ids) or sheet.calls != calls + 1:
+        failures.append('the rows were not loaded from the store')
+    store.close()
+
+    return failures
+
+
+def report_check_resume():
+
+    # The logs and messages of the stopped run are kept out of the report
+    logging.disable(logging.CRITICAL)
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        failures = check_resume()
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+        logging.disable(logging.NOTSET)
+
+    for failure in failures:
+        print('Resume check failed: %s' % failure)
+    if len(failures) == 0:
+        print('Resume check passed')
+
+    return len(failures) == 0
+
+
+def report_check_pool(size=1000):
+
+    # 1000 posts are 20 chunks of Tchop cards and 20 pages of Blogger posts
+    pool = normalize_pool()
+    if pool is None:
+        print('Pool check skipped: worker processes cannot be forked here')
+        return True
+
+    with pool:
+        mismatches = pooled_mismatches(pool, size)
+
+    for source in mismatches:
+        print('Pool check failed: %s rows differ from the collector thread' % source)
+    if len(mismatches) == 0:
+        print('Pool check passed')
+
+    return len(mismatches) == 0
+
+
+def used_summary(summary):
+
+    # The stream parser stops at the first <a href>: the iframe is only read for posts without a link
+    if summary.has_link:
+        return summary._replace(has_iframe=None, iframe_src=None, iframe_thumbnail=None)
+    return summary
+
+
+def report_check_html():
+
+    # The lxml backend, when installed, extracts the same text, links and images as the stream parser
+    backends = ['lxml'] if CommContentHtml.lxml is not None else []
+    if len(backends) == 0:
+        print('HTML check skipped: lxml is not installed')
+        return True
+
+    samples = HTML_SAMPLES + [synthetic_html(random.Random(seed)) for seed in range(5)]
+    failures = []
+    for backend in backends:
+        for idx, html in enumerate(samples):
+            for media in [None, 'links', 'image']:
+                if used_summary(summarize_html(html, 1000, media, backend)) != \
+                        used_summary(summarize_html(html, 1000, media, 'stream')):
+                    failures.append('%s backend differs on sample %s with media %s' % (backend, idx, media))
+
+    for failure in failures:
+        print('HTML check failed: %s' % failure)
+    if len(failures) == 0:
+        print('HTML check passed')
+
+    return len(failures) == 0
+
+
+def import_time(repeat):
+
+    # Best time to import CommContentProcessing, each time in a new interpreter so that nothing is cached,
+    # and the heavy libraries it loaded
+    best = None
+    for run in range(repeat):
+        output = subprocess.run([sys.executable, '-c', IMPORT_CHECK], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output)
+        best = result['seconds'] if best is None else min(best, result['seconds'])
+
+    return best, [module for module in HEAVY_MODULES if module in result['modules']]
+
+
+def check_import_budget(budget=IMPORT_TIME_BUDGET, repeat=3):
+
+    # True when the entry point starts within the budget without loading any heavy library
+    seconds, heavy_modules = import_time(repeat)
+
+    print('import CommContentProcessing: %.3f seconds (budget %.3f)' % (seconds, budget))
+    if len(heavy_modules) > 0:
+        print('Heavy libraries loaded at import: %s' % ', '.join(heavy_modules))
+
+    return seconds <= budget and len(heavy_modules) == 0
+
+
+def main(sizes, repeat, output=None):
+
+    # sizes: (posts, rows, features) of each run
+    # Logging of the processing is kept out of the measures
+    logging.disable(logging.INFO)
+    sys.stdout = open(os.devnull, 'w')
+
+    report = {}
+    try:
+        for posts, rows, features in sizes:
+            report['%s/%s/%s' % (posts, rows, features)] = benchmark_size(posts, rows, features, repeat)
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+    # One line per benchmark, time per item to spot what does not scale linearly
+    # Items are the posts, rows or features that drive each benchmark
+    print('%-24s %20s %10s %12s %14s' % ('benchmark', 'posts/rows/features', 'items', 'seconds', 'us per item'))
+    runs = list(report)
+    for name in report[runs[0]]:
+        for run in runs:
+            seconds, items = report[run][name]
+            print('%-24s %20s %10s %12.3f %14.1f' % (name, run, items, seconds, seconds / items * 1000000))
+
+    if output is not None:
+        with open(output, 'w') as report_output:
+            json.dump({run: {name: {'seconds': seconds, 'items': items} for name, (seconds, items) in results.items()}
+                       for run, results in report.items()}, report_output, indent=2)
+
+    return report
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Offline benchmark of the content processing')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000],
+                        help='number of posts, sheet rows and layer features of each run')
+    parser.add_argument('--posts', type=int, nargs='+', help='posts harvested per source of each run, '
+                                                             'instead of --sizes')
+    parser.add_argument('--rows', type=int, nargs='+', help='rows already in the sheet of each run, instead of --sizes')
+    parser.add_argument('--features', type=int, nargs='+', help='features already in the layer of each run, '
+                                                                'instead of --sizes')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, the best time is kept')
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--import-budget', type=float, nargs='?', const=IMPORT_TIME_BUDGET, metavar='SECONDS',
+                        help='only check that CommContentProcessing imports within the budget, without heavy '
+                             'libraries, and exit with an error otherwise')
+    parser.add_argument('--check-html', action='store_true',
+                        help='only check that the HTML extraction backends give the same results, '
+                             'and exit with an error otherwise')
+    parser.add_argument('--check-pool', action='store_true',
+                        help='only check that the worker processes normalize the same rows as the collector '
+                             'thread, and exit with an error otherwise')
+    parser.add_argument('--check-resume', action='store_true',
+                        help='only check that a run stopped halfway is resumed without appending rows twice, '
+                             'and exit with an error otherwise')
+    args = parser.parse_args()
+
+    if args.import_budget is not None:
+        sys.exit(0 if check_import_budget(args.import_budget, args.repeat) else 1)
+
+    if args.check_html:
+        sys.exit(0 if report_check_html() else 1)
+
+    if args.check_pool:
+        sys.exit(0 if report_check_pool() else 1)
+
+    if args.check_resume:
+        sys.exit(0 if report_check_resume() else 1)
+
+    # A single value applies to every run, e.g. --rows 50000 --posts 100 1000 10000
+    scales = [args.posts or args.sizes, args.rows or args.sizes, args.features or args.sizes]
+    runs = max(len(scale) for scale in scales)
+    if any(len(scale) not in (1, runs) for scale in scales):
+        parser.error('--sizes, --posts, --rows and --features give either one size or one size per run')
+
+    main([tuple(scale[run] if len(scale) > 1 else scale[0] for scale in scales) for run in range(runs)],
+         args.repeat, args.output)
@@ -0,0 +1,97 @@
+# CommContentGoogle.py
+#
+# Authorized clients of the Google APIs (Sheets, YouTube, Blogger), only
+# imported by the stages that talk to Google: each service is built once per
+# process from the discovery documents shipped with the client library, and
+# all the services share the same keep-alive connections
+
+# Standard libraries
+import os
+import pickle
+import threading
+from functools import lru_cache
+
+# Libraries to be installed with pip
+import httplib2
+import google_auth_httplib2
+from googleapiclient.discovery import build
+from google_auth_oauthlib.flow import InstalledAppFlow
+
+# Default settings, can be overridden in the variable file
+GOOGLE_HTTP_TIMEOUT = 120  # Seconds before a call to a Google API times out
+
+# Variable file
+from CommContentProcessingVariables import *
+
+
+class SharedHttp:
+
+    # Transport shared by all the Google services of the process
+    # httplib2.Http is not thread safe: each thread (sheet update, YouTube and Blogger collectors)
+    # gets its own pool of keep-alive connections, used by every service called from that thread
+
+    def __init__(self, timeout=GOOGLE_HTTP_TIMEOUT):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def thread_http(self):
+        if not hasattr(self.local, 'http'):
+            self.local.http = httplib2.Http(timeout=self.timeout)
+        return self.local.http
+
+    def request(self, *args, **kwargs):
+        return self.thread_http().request(*args, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def shared_google_http():
+
+    # One transport for the process lifetime
+    return SharedHttp()
+
+
+@lru_cache(maxsize=None)
+def google_credentials(scope, pickle_file, credentials_file):
+
+    creds = None
+    # The pickle file  stores the user's access and refresh tokens, and is
+    # created automatically when the authorization flow completes for the first
+    # time.
+    if os.path.exists(pickle_file):
+        with open(pickle_file, 'rb') as token:
+            creds = pickle.load(token)
+    # If there are no (valid) credentials available, let the user log in.
+    # Credentials stay valid until a few minutes before they expire: a token
+    # still good is used as is, and the authorized transport refreshes it when
+    # it comes close to expiry during the run
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(google_auth_httplib2.Request(shared_google_http()))
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(
+                credentials_file, list(scope))
+            creds = flow.run_local_server()
+        # Save the credentials for the next run
+        with open(pickle_file, 'wb') as token:
+            pickle.dump(creds, token)
+
+    return creds
+
+
+# Services are built once even when two collector threads ask for them at the same time
+service_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def google_service(api, version, scope, pickle_file, credentials_file):
+
+    # The discovery document is read from the copy shipped with the client library, never downloaded
+    http = google_auth_httplib2.AuthorizedHttp(google_credentials(scope, pickle_file, credentials_file),
+                                               http=shared_google_http())
+    return build(api, version, http=http, static_discovery=True, cache_discovery=False)
+
+
+def google_service_init(api, version, scope, pickle_file, credentials_file):
+
+    with service_lock:
+        return google_service(api, version, tuple(scope), pickle_file, credentials_file)
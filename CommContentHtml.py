@@ -0,0 +1,241 @@
+# CommContentHtml.py
+#
+# Fast extraction of the start of the text and the first link, iframe or image
+# of a Blogger/Wordpress post body, in a single pass that stops as soon as
+# everything needed has been found
+
+# Standard libraries
+from collections import namedtuple
+from html.parser import HTMLParser
+
+# Libraries to be installed with pip (optional)
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# Default settings, can be overridden in the variable file
+HTML_EXTRACTION_BACKEND = 'stream'  # 'stream' (standard library, stops early) or 'lxml'
+
+# Variable file
+from CommContentProcessingVariables import *
+
+
+# text: start of the text of the page, at least text_length characters when available
+# has_link/link: whether a <a href> exists / href of the first <a> (as find_all('a')[0].get('href'))
+# has_iframe/iframe_src/iframe_thumbnail: same for <iframe src>, with its data-thumbnail-src
+# image: src of the first <img>, None if there is no image
+HtmlSummary = namedtuple('HtmlSummary', ['text', 'has_link', 'link', 'has_iframe', 'iframe_src',
+                                         'iframe_thumbnail', 'image'])
+
+# Elements whose content is not part of get_text()
+HIDDEN_ELEMENTS = ['script', 'style', 'template']
+
+# Elements where BeautifulSoup keeps whitespace as is
+PRESERVE_WHITESPACE_ELEMENTS = ['pre', 'textarea']
+
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+
+def collapse_whitespace(text):
+
+    # Like BeautifulSoup, a text made only of whitespace becomes a single newline or space
+    if text.strip(ASCII_SPACES) == '':
+        return '\n' if '\n' in text else ' '
+    return text
+
+
+class ExtractionDone(Exception):
+    pass
+
+
+class SummaryParser(HTMLParser):
+
+    # media: 'links' for the first <a>/<iframe>, 'image' for the first <img>, None for the text only
+
+    def __init__(self, text_length, media):
+        super().__init__(convert_charrefs=True)
+        self.text_length = text_length
+        self.media = media
+
+        self.text_parts = []
+        self.text_size = 0
+        self.pending_text = []
+        self.hidden_depth = 0
+        self.preserve_depth = 0
+
+        self.first_link = None
+        self.has_link = False
+        self.first_iframe = None
+        self.has_iframe = False
+        self.first_image = None
+
+    def media_done(self):
+        # A <a href> anywhere wins over any iframe, so links are only done once one is found
+        if self.media == 'links':
+            return self.has_link
+        if self.media == 'image':
+            return self.first_image is not None
+        return True
+
+    def check_done(self):
+        if self.text_size >= self.text_length and self.media_done():
+            raise ExtractionDone()
+
+    def flush_text(self):
+        # A text node ends at the next tag, comment or declaration
+        if len(self.pending_text) == 0:
+            return
+
+        text = ''.join(self.pending_text)
+        self.pending_text = []
+
+        if self.preserve_depth == 0:
+            text = collapse_whitespace(text)
+
+        if self.text_size < self.text_length:
+            self.text_parts.append(text)
+            self.text_size = self.text_size + len(text)
+
+    def handle_starttag(self, tag, attrs):
+        self.flush_text()
+
+        if tag in HIDDEN_ELEMENTS:
+            self.hidden_depth = self.hidden_depth + 1
+            return
+
+        if tag in PRESERVE_WHITESPACE_ELEMENTS:
+            self.preserve_depth = self.preserve_depth + 1
+
+        if self.media == 'links':
+            if tag == 'a':
+                attributes = dict(attrs)
+                if self.first_link is None:
+                    self.first_link = attributes
+                if 'href' in attributes:
+                    self.has_link = True
+            elif tag == 'iframe':
+                attributes = dict(attrs)
+                if self.first_iframe is None:
+                    self.first_iframe = attributes
+                if 'src' in attributes:
+                    self.has_iframe = True
+        elif self.media == 'image' and tag == 'img' and self.first_image is None:
+            self.first_image = dict(attrs)
+
+        self.check_done()
+
+    def handle_startendtag(self, tag, attrs):
+        # <tag/> never opens an element
+        self.handle_starttag(tag, attrs)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self.flush_text()
+
+        if tag in HIDDEN_ELEMENTS and self.hidden_depth > 0:
+            self.hidden_depth = self.hidden_depth - 1
+        elif tag in PRESERVE_WHITESPACE_ELEMENTS and self.preserve_depth > 0:
+            self.preserve_depth = self.preserve_depth - 1
+
+        self.check_done()
+
+    def handle_data(self, data):
+        if self.hidden_depth == 0 and self.text_size < self.text_length:
+            self.pending_text.append(data)
+
+    def handle_comment(self, data):
+        self.flush_text()
+
+    def handle_decl(self, decl):
+        self.flush_text()
+
+    def handle_pi(self, data):
+        self.flush_text()
+
+    def unknown_decl(self, data):
+        self.flush_text()
+
+    def summary(self):
+        self.flush_text()
+
+        first_link = self.first_link or {}
+        first_iframe = self.first_iframe or {}
+        first_image = self.first_image or {}
+
+        return HtmlSummary(
+            text=''.join(self.text_parts)[:self.text_length],
+            has_link=self.has_link,
+            link=first_link.get('href'),
+            has_iframe=self.has_iframe,
+            iframe_src=first_iframe.get('src'),
+            iframe_thumbnail=first_iframe.get('data-thumbnail-src'),
+            image=first_image.get('src')
+        )
+
+
+def summarize_stream(html, text_length, media):
+
+    parser = SummaryParser(text_length, media)
+    try:
+        parser.feed(html)
+        parser.close()
+    except ExtractionDone:
+        pass
+
+    return parser.summary()
+
+
+def preserves_whitespace(text_node):
+
+    # Whether a text node of the lxml tree is inside a <pre>/<textarea>
+    # The tail text of an element follows it: it is enclosed by the parent of that element
+    element = text_node.getparent()
+    if text_node.is_tail:
+        element = element.getparent()
+
+    while element is not None:
+        if element.tag in PRESERVE_WHITESPACE_ELEMENTS:
+            return True
+        element = element.getparent()
+
+    return False
+
+
+def summarize_lxml(html, text_length, media):
+
+    # Whole tree built in C: no early stop, but much faster than a Python parser on long posts
+    # libxml2 repairs broken markup its own way (e.g. text inside <iframe>), so results
+    # can differ from html.parser on malformed posts
+    try:
+        root = lxml.html.document_fromstring(html)
+    except lxml.etree.ParserError:
+        # Empty document
+        return HtmlSummary('', False, None, False, None, None, None)
+
+    text_nodes = root.xpath('//text()[not(ancestor::script or ancestor::style or ancestor::template)]')
+    text = ''.join(node if preserves_whitespace(node) else collapse_whitespace(node) for node in text_nodes)
+
+    links = root.xpath('//a') if media == 'links' else []
+    iframes = root.xpath('//iframe') if media == 'links' else []
+    images = root.xpath('//img') if media == 'image' else []
+
+    return HtmlSummary(
+        text=text[:text_length],
+        has_link=any(link.get('href') is not None for link in links),
+        link=links[0].get('href') if len(links) > 0 else None,
+        has_iframe=any(iframe.get('src') is not None for iframe in iframes),
+        iframe_src=iframes[0].get('src') if len(iframes) > 0 else None,
+        iframe_thumbnail=iframes[0].get('data-thumbnail-src') if len(iframes) > 0 else None,
+        image=images[0].get('src') if len(images) > 0 else None
+    )
+
+
+def summarize_html(html, text_length=150, media=None, backend=HTML_EXTRACTION_BACKEND):
+
+    # Same results as BeautifulSoup(html, 'html.parser').get_text()[:text_length]
+    # and find_all('a'/'iframe'/'img')[0], without building the whole tree
+    if backend == 'lxml' and lxml is not None:
+        return summarize_lxml(html, text_length, media)
+
+    return summarize_stream(html, text_length, media)
@@ -0,0 +1,247 @@
+# CommContentHttp.py
+#
+# Shared HTTP layer for the content sources: one pooled requests session
+# and an on-disk cache revalidated with conditional requests (ETag/Last-Modified)
+#
+# An entry is confirmed once the rows of its response are safely in the sheet:
+# an unchanged confirmed response does not need to be parsed again
+
+# Standard libraries
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+from functools import lru_cache
+
+# Libraries to be installed with pip
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+# Default settings, can be overridden in the variable file
+HTTP_CACHE_DIR = 'http-cache'  # Folder of the cached responses
+HTTP_CACHE_MAX_AGE_DAYS = 30  # Entries not used for that many days are removed
+HTTP_CACHE_MAX_SIZE = 200 * 1024 * 1024  # Bytes kept on disk, least recently used entries removed first
+HTTP_POOL_SIZE = 10  # Connections kept alive per host
+
+# Variable file
+from CommContentProcessingVariables import *
+
+# Run instrumentation
+from CommContentMetrics import run_metrics
+
+# Retries and rate limits
+from CommContentRetry import call_with_retry, RETRY_STATUSES
+
+
+class HttpCache:
+
+    # GET requests through a pooled session, with responses kept on disk
+    # A cached response is sent back with If-None-Match/If-Modified-Since and reused on 304
+
+    def __init__(self, cache_dir=HTTP_CACHE_DIR, max_age_days=HTTP_CACHE_MAX_AGE_DAYS,
+                 max_size=HTTP_CACHE_MAX_SIZE, pool_size=HTTP_POOL_SIZE):
+        self.cache_dir = cache_dir
+        self.max_age_days = max_age_days
+        self.max_size = max_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        # Entries written or revalidated during the run and not confirmed yet, by service
+        self.unconfirmed = {}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def entry_path(self, url, params):
+        # Entries are keyed by URL and sorted parameters
+        key = json.dumps([url, sorted((params or {}).items())], default=str)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, url, params=None, service='HTTP', cache=True, **kwargs):
+
+        # service: name under which the call is counted in the run report
+        # cache False for requests that will not be sent again, e.g. with a date filter that changes at each run
+
+        if not cache:
+            response = call_with_retry(service, self.fetch, service, url, params, dict(kwargs.pop('headers', {})),
+                                       kwargs)
+            response.from_cache = False
+            response.confirmed = False
+            return response
+
+        path = self.entry_path(url, params)
+        entry = self.read_entry(path)
+
+        headers = dict(kwargs.pop('headers', {}))
+        if entry is not None:
+            if entry['etag'] is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = call_with_retry(service, self.fetch, service, url, params, headers, kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            with self.lock:
+                self.hits = self.hits + 1
+            # Mark the entry as recently used for the eviction
+            os.utime(path + '.json')
+            if not entry.get('confirmed', False):
+                self.add_unconfirmed(service, path)
+            return self.cached_response(response, path, entry)
+
+        with self.lock:
+            self.misses = self.misses + 1
+
+        response.from_cache = False
+        response.confirmed = False
+
+        # Only responses that can be revalidated are worth keeping
+        if response.status_code == 200 and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+            self.write_entry(path, response)
+            self.add_unconfirmed(service, path)
+
+        return response
+
+    def add_unconfirmed(self, service, path):
+        with self.lock:
+            self.unconfirmed.setdefault(service, []).append(path)
+
+    def confirm(self, services):
+
+        # The responses of these services were read to the end and their rows saved in the sheet
+        for service in services:
+            with self.lock:
+                paths = self.unconfirmed.pop(service, [])
+            for path in paths:
+                entry = self.read_entry(path)
+                if entry is not None:
+                    entry['confirmed'] = True
+                    with open(path + '.json.tmp', 'w') as entry_file:
+                        json.dump(entry, entry_file)
+                    os.replace(path + '.json.tmp', path + '.json')
+
+    def fetch(self, service, url, params, headers, kwargs):
+
+        # One attempt of the request, a transient error status is raised to be retried
+        start = time.time()
+        try:
+            response = self.session.get(url, params=params, headers=headers, **kwargs)
+        except requests.RequestException:
+            run_metrics().record_call(service, time.time() - start, error=True)
+            raise
+        # A 304 carries no body: only the bytes actually downloaded are counted
+        run_metrics().record_call(service, time.time() - start, len(response.content),
+                                  error=response.status_code >= 400)
+
+        if response.status_code in RETRY_STATUSES:
+            raise requests.HTTPError('%s error for url: %s' % (response.status_code, response.url), response=response)
+
+        return response
+
+    def read_entry(self, path):
+        if not os.path.exists(path + '.json') or not os.path.exists(path + '.body'):
+            return None
+
+        try:
+            with open(path + '.json', 'r') as entry_file:
+                return json.load(entry_file)
+        except ValueError:
+            return None
+
+    def write_entry(self, path, response):
+        entry = {
+            'url': response.url.split('?')[0],
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'encoding': response.encoding,
+            'headers': dict(response.headers),
+            'confirmed': False
+        }
+
+        # Body first, then metadata: an entry is only used once both files exist
+        with open(path + '.body.tmp', 'wb') as body_file:
+            body_file.write(response.content)
+        os.replace(path + '.body.tmp', path + '.body')
+
+        with open(path + '.json.tmp', 'w') as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(path + '.json.tmp', path + '.json')
+
+    def cached_response(self, not_modified_response, path, entry):
+        # Rebuild a 200 response from the stored body and headers
+        response = requests.Response()
+        response.status_code = 200
+        response.url = not_modified_response.url
+        response.request = not_modified_response.request
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = entry['encoding']
+
+        with open(path + '.body', 'rb') as body_file:
+            response._content = body_file.read()
+
+        response.from_cache = True
+        response.confirmed = entry.get('confirmed', False)
+
+        return response
+
+    def evict(self):
+
+        # Remove entries not used for too long, then the least recently used ones above the size limit
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            if file.endswith('.json'):
+                path = os.path.join(self.cache_dir, file[:-len('.json')])
+                try:
+                    last_used = os.path.getmtime(path + '.json')
+                    size = os.path.getsize(path + '.json') + os.path.getsize(path + '.body')
+                except OSError:
+                    last_used = 0
+                    size = 0
+                entries.append((last_used, size, path))
+
+        entries.sort()
+        total_size = sum(size for last_used, size, path in entries)
+        oldest_allowed = time.time() - self.max_age_days * 24 * 3600
+
+        counter_evicted = 0
+        for last_used, size, path in entries:
+            if last_used >= oldest_allowed and total_size <= self.max_size:
+                break
+            for extension in ['.json', '.body']:
+                if os.path.exists(path + extension):
+                    os.remove(path + extension)
+            total_size = total_size - size
+            counter_evicted = counter_evicted + 1
+
+        return counter_evicted
+
+    def log_statistics(self):
+        logging.info('HTTP cache hits: %s, misses: %s' % (self.hits, self.misses))
+        print('HTTP cache hits: %s, misses: %s' % (self.hits, self.misses))
+
+
+# The cache is created once even when two collector threads ask for it at the same time
+cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def http_cache():
+
+    # One session and cache shared by every source for the process lifetime
+    return HttpCache()
+
+
+def shared_http_cache():
+
+    with cache_lock:
+        return http_cache()
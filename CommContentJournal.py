@@ -0,0 +1,172 @@
+# CommContentJournal.py
+#
+# Checkpoint journal of the runs in a SQLite file: stages completed and rows
+# harvested from each source, so that a run that stopped halfway is resumed
+# without doing its finished work again. The rows already saved in the Google
+# Sheet and the feature layer are known from the content store
+
+# Standard libraries
+import json
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+
+# Default settings, can be overridden in the variable file
+CHECKPOINT_FILE = 'checkpoint.sqlite'  # Journal of the runs
+CHECKPOINT_MAX_AGE_HOURS = 12  # An unfinished run older than that is abandoned, e.g. by the next daily run
+CHECKPOINT_KEEP_RUNS = 7  # Runs kept in the journal
+CHECKPOINT_REPLAY_BATCH_SIZE = 500  # Rows given at once when a harvested source is replayed
+
+# Variable file
+from CommContentProcessingVariables import *
+
+# Content rows
+from CommContentRecord import ContentRecord
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started TEXT NOT NULL,
+    finished TEXT,
+    options TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    completed TEXT NOT NULL,
+    PRIMARY KEY (run_id, stage)
+);
+CREATE TABLE IF NOT EXISTS harvested_rows (
+    run_id INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    record TEXT NOT NULL,
+    PRIMARY KEY (run_id, source, seq)
+);
+CREATE TABLE IF NOT EXISTS harvested_sources (
+    run_id INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    completed TEXT NOT NULL,
+    PRIMARY KEY (run_id, source)
+);
+'''
+
+
+def now_text():
+    return datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def record_to_json(record):
+    return json.dumps(list(record.text_values()) + [record.latitude, record.longitude])
+
+
+def record_from_json(text):
+    values = json.loads(text)
+    return ContentRecord(*values[:-2], latitude=values[-2], longitude=values[-1])
+
+
+class RunJournal:
+
+    # Journal of the current run, opened from the main thread
+    # Every write is committed at once: what is in the journal has been done
+
+    def __init__(self, journal_file=CHECKPOINT_FILE):
+        self.journal_file = journal_file
+        self.connection = sqlite3.connect(journal_file)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+        self.run_id = None
+        self.resumed = False
+        self.options = {}
+
+    def start_run(self, options, resume=True, max_age_hours=CHECKPOINT_MAX_AGE_HOURS):
+
+        # Resume the last run if it did not finish recently, otherwise start a new one
+        # A resumed run keeps its options, e.g. a full resync stays a full resync
+        last_run = self.connection.execute(
+            'SELECT run_id, started, finished, options FROM runs ORDER BY run_id DESC LIMIT 1').fetchone()
+
+        oldest_allowed = (datetime.now() - timedelta(hours=max_age_hours)).strftime('%Y-%m-%dT%H:%M:%S')
+
+        if resume and last_run is not None and last_run[2] is None and last_run[1] >= oldest_allowed:
+            self.run_id = last_run[0]
+            self.resumed = True
+            self.options = json.loads(last_run[3])
+            logging.info('### Resuming run %s started %s' % (self.run_id, last_run[1]))
+            print('Resuming run started %s' % last_run[1])
+        else:
+            with self.connection:
+                if last_run is not None and last_run[2] is None:
+                    logging.info('### Unfinished run %s abandoned' % last_run[0])
+                cursor = self.connection.execute('INSERT INTO runs (started, options) VALUES (?, ?)',
+                                                 (now_text(), json.dumps(options)))
+            self.run_id = cursor.lastrowid
+            self.resumed = False
+            self.options = dict(options)
+
+        self.prune()
+
+        return self.options
+
+    def prune(self, keep_runs=CHECKPOINT_KEEP_RUNS):
+        with self.connection:
+            for table in ['stages', 'harvested_rows', 'harvested_sources', 'runs']:
+                self.connection.execute('DELETE FROM %s WHERE run_id <= ?' % table, (self.run_id - keep_runs,))
+
+    def finish_run(self):
+        with self.connection:
+            self.connection.execute('UPDATE runs SET finished = ? WHERE run_id = ?', (now_text(), self.run_id))
+            # The rows harvested are only needed to resume the run
+            self.connection.execute('DELETE FROM harvested_rows WHERE run_id = ?', (self.run_id,))
+
+    def stage_done(self, stage):
+        return self.connection.execute('SELECT 1 FROM stages WHERE run_id = ? AND stage = ?',
+                                       (self.run_id, stage)).fetchone() is not None
+
+    def complete_stage(self, stage):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?)', (self.run_id, stage, now_text()))
+
+    def source_done(self, source):
+        return self.connection.execute('SELECT 1 FROM harvested_sources WHERE run_id = ? AND source = ?',
+                                       (self.run_id, source)).fetchone() is not None
+
+    def discard_source(self, source):
+        # Rows of a source that was not read to the end, before it is harvested again
+        with self.connection:
+            self.connection.execute('DELETE FROM harvested_rows WHERE run_id = ? AND source = ?', (self.run_id, source))
+
+    def record_rows(self, source, records):
+        with self.connection:
+            seq = self.connection.execute('SELECT COALESCE(MAX(seq), -1) + 1 FROM harvested_rows '
+                                          'WHERE run_id = ? AND source = ?', (self.run_id, source)).fetchone()[0]
+            self.connection.executemany('INSERT INTO harvested_rows VALUES (?, ?, ?, ?)',
+                                        [(self.run_id, source, seq + idx, record_to_json(record))
+                                         for idx, record in enumerate(records)])
+
+    def complete_source(self, source):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO harvested_sources VALUES (?, ?, ?)',
+                                    (self.run_id, source, now_text()))
+
+    def replay_source(self, source, batch_size=CHECKPOINT_REPLAY_BATCH_SIZE):
+
+        # Rows of a source harvested by the resumed run, in batches as a collector gives them
+        # Run in the harvesting thread: reads through its own connection
+        connection = sqlite3.connect(self.journal_file)
+        try:
+            cursor = connection.execute('SELECT record FROM harvested_rows WHERE run_id = ? AND source = ? '
+                                        'ORDER BY seq', (self.run_id, source))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                yield [record_from_json(row[0]) for row in rows]
+        finally:
+            connection.close()
+
+    def close(self):
+        self.connection.close()
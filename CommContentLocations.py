@@ -0,0 +1,191 @@
+# CommContentLocations.py
+#
+# Latitude/longitude of the Wordpress posts, exported from the GEO my WP
+# locations table and kept as a compact post_id index between runs
+
+# Standard libraries
+import os
+import csv
+import base64
+import bisect
+import hashlib
+import logging
+import pickle
+import time
+from array import array
+
+# Default settings, can be overridden in the variable file
+WORDPRESS_LOCATION_PROVIDER = 'selenium'  # 'selenium', 'http' or 'file' to use WORDPRESS_LOCATION_CSV as is
+WORDPRESS_LOCATION_EXPORT_URL = None  # Direct CSV export URL used by the 'http' provider
+WORDPRESS_LOCATION_INDEX = 'wordpress-locations.idx'  # Index persisted between runs
+
+# Variable file
+from CommContentProcessingVariables import *
+
+# Run instrumentation
+from CommContentMetrics import run_metrics
+
+
+class LocationIndex:
+
+    # post_id -> (latitude, longitude) stored in three parallel arrays sorted by post_id
+
+    def __init__(self, locations):
+        locations = sorted(locations)
+        self.post_ids = array('q', [location[0] for location in locations])
+        self.latitudes = array('d', [location[1] for location in locations])
+        self.longitudes = array('d', [location[2] for location in locations])
+
+    def __len__(self):
+        return len(self.post_ids)
+
+    def get(self, post_id):
+        position = bisect.bisect_left(self.post_ids, post_id)
+        if position < len(self.post_ids) and self.post_ids[position] == post_id:
+            return self.latitudes[position], self.longitudes[position]
+        return None
+
+
+def read_location_csv(csv_file):
+
+    # Stream the export line by line
+    # 2 -> object_id (post_id), 9 -> latitude, 10 -> longitude
+    locations = {}
+
+    with open(csv_file, 'r', newline='', encoding='utf-8-sig') as location_csv:
+        reader = csv.reader(location_csv)
+        next(reader, None)  # header
+
+        for row in reader:
+            try:
+                locations[int(row[2])] = (float(row[9]), float(row[10]))
+            except (IndexError, ValueError):
+                # Incomplete line, the post will get no location
+                continue
+
+    return LocationIndex((post_id, latitude, longitude) for post_id, (latitude, longitude) in locations.items())
+
+
+def file_signature(file):
+
+    with open(file, 'rb') as content:
+        return hashlib.sha1(content.read()).hexdigest()
+
+
+def load_location_index(csv_file=WORDPRESS_LOCATION_CSV, index_file=WORDPRESS_LOCATION_INDEX):
+
+    # The CSV is only parsed again when it changed: same mtime and size, or else same hash
+    stat = os.stat(csv_file)
+    stored = None
+
+    if os.path.exists(index_file):
+        with open(index_file, 'rb') as index:
+            stored = pickle.load(index)
+
+        if (stored['mtime'], stored['size']) == (stat.st_mtime, stat.st_size):
+            return stored['index']
+
+    signature = file_signature(csv_file)
+
+    if stored is not None and stored['signature'] == signature:
+        location_index = stored['index']
+    else:
+        logging.info('Wordpress location table changed, index rebuilt')
+        location_index = read_location_csv(csv_file)
+
+    with open(index_file + '.tmp', 'wb') as index:
+        pickle.dump({
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'signature': signature,
+            'index': location_index
+        }, index)
+    os.replace(index_file + '.tmp', index_file)
+
+    return location_index
+
+
+def export_location_table():
+
+    # Imported here: Chrome automation is only needed by the 'selenium' provider
+    from selenium import webdriver
+    from selenium.webdriver.common.keys import Keys
+
+    try:
+        logging.info('Start automated Chrome browser')
+        chrome_options = webdriver.ChromeOptions()
+        prefs = {"download.default_directory": WORDPRESS_LOCATION_EXPORT_DIR}
+        chrome_options.add_experimental_option("prefs", prefs)
+
+        browser = webdriver.Chrome(chrome_options=chrome_options)
+        browser.get(WORDPRESS_LOCATION_TABLE_URL)
+        browser.implicitly_wait(2)
+
+        element1 = browser.find_element_by_id('usernameOrEmail')
+        element1.send_keys(WORDPRESS_USERNAME)
+        element1.send_keys(Keys.RETURN)
+        browser.implicitly_wait(2)
+
+        wordpress_password = base64.b64decode(WORDPRESS_PASSWORD).decode("utf-8")
+
+        element2 = browser.find_element_by_id('password')
+        element2.send_keys(wordpress_password)
+        element2.send_keys(Keys.RETURN)
+        browser.implicitly_wait(2)
+
+        element3 = browser.find_element_by_id('export_locations_table')
+        element3.click()
+
+        browser.implicitly_wait(5)
+        time.sleep(5)
+
+        browser.close()
+        logging.info('Close automated Chrome browser')
+
+        for root, dirs, files in os.walk(WORDPRESS_LOCATION_EXPORT_DIR):
+            for file in files:
+                # print(root, dirs, file)
+                if file[0:3] == 'gmw':
+                    exported_file = root + '\\' + file
+                    os.remove(WORDPRESS_LOCATION_CSV)
+                    os.rename(exported_file, WORDPRESS_LOCATION_CSV)
+    except:
+        logging.error('Wordpress geo coordinate information ould not be retrieved')
+
+
+def download_location_table():
+
+    # Plain HTTP download of the export, revalidated with the shared HTTP cache
+    from CommContentHttp import shared_http_cache
+
+    try:
+        wordpress_password = base64.b64decode(WORDPRESS_PASSWORD).decode("utf-8")
+        response = shared_http_cache().get(WORDPRESS_LOCATION_EXPORT_URL,
+                                           auth=(WORDPRESS_USERNAME, wordpress_password), service='Wordpress')
+        response.raise_for_status()
+
+        # Unchanged export: the file on disk is already up to date
+        if not response.from_cache or not os.path.exists(WORDPRESS_LOCATION_CSV):
+            with open(WORDPRESS_LOCATION_CSV + '.tmp', 'wb') as location_csv:
+                location_csv.write(response.content)
+            os.replace(WORDPRESS_LOCATION_CSV + '.tmp', WORDPRESS_LOCATION_CSV)
+    except Exception as error:
+        logging.error('Wordpress geo coordinate information could not be downloaded: %s' % error)
+
+
+def wordpress_locations(provider=WORDPRESS_LOCATION_PROVIDER):
+
+    # Refresh the export with the configured provider, then load the index
+    if provider == 'selenium':
+        with run_metrics().call('Selenium'):
+            export_location_table()
+    elif provider == 'http':
+        download_location_table()
+    elif provider != 'file':
+        raise ValueError('Unknown Wordpress location provider: %s' % provider)
+
+    if not os.path.exists(WORDPRESS_LOCATION_CSV):
+        logging.error('No Wordpress location table, posts will get no location')
+        return LocationIndex([])
+
+    return load_location_index()
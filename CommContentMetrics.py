@@ -0,0 +1,174 @@
+# CommContentMetrics.py
+#
+# Run instrumentation: wall time of each stage of the process, calls, errors,
+# retries and bytes of each external service, rows counted by each stage,
+# written at the end of the run as a JSON report
+
+# Standard libraries
+import os
+import json
+import time
+import logging
+import threading
+import cProfile
+import tracemalloc
+from datetime import datetime
+from functools import lru_cache
+from contextlib import contextmanager
+
+# Default settings, can be overridden in the variable file
+RUN_REPORT_FILE = 'run-report.json'  # JSON report of the last run
+PROFILE_STAGES = []  # Stages run under cProfile, e.g. ['Google Sheet update'], profiles saved in PROFILE_DIR
+PROFILE_DIR = 'profiles'  # Folder of the <stage>.prof files, to be read with pstats or snakeviz
+TRACE_MEMORY = False  # Record the peak Python memory of each stage with tracemalloc (slows the run down)
+
+# Variable file
+from CommContentProcessingVariables import *
+
+
+class RunMetrics:
+
+    # Counters of one run, shared by all the threads of the process
+
+    def __init__(self, profile_stages=PROFILE_STAGES, trace_memory=TRACE_MEMORY):
+        self.profile_stages = list(profile_stages)
+        self.trace_memory = trace_memory
+
+        self.started = datetime.now()
+        self.start_time = time.time()
+        self.stages = {}
+        self.services = {}
+        self.lock = threading.Lock()
+
+    def stage_entry(self, name):
+        # Stages keep the order they were first run in
+        return self.stages.setdefault(name, {'seconds': 0.0, 'runs': 0, 'counters': {}})
+
+    def service_entry(self, service):
+        return self.services.setdefault(service, {'calls': 0, 'errors': 0, 'retries': 0, 'bytes': 0, 'seconds': 0.0})
+
+    @contextmanager
+    def stage(self, name):
+
+        # Time a stage of main(), optionally under cProfile and tracemalloc
+        # cProfile only sees the thread running the stage, not the collector threads
+        profiler = None
+        if name in self.profile_stages:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+        logging.info('### Stage %s started' % name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+
+            with self.lock:
+                entry = self.stage_entry(name)
+                entry['seconds'] = entry['seconds'] + seconds
+                entry['runs'] = entry['runs'] + 1
+                if self.trace_memory:
+                    entry['peak_memory'] = max(entry.get('peak_memory', 0), tracemalloc.get_traced_memory()[1])
+
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                profiler.dump_stats(os.path.join(PROFILE_DIR, '%s.prof' % name.replace(' ', '-')))
+
+            logging.info('### Stage %s done in %.1f seconds' % (name, seconds))
+
+    def add_counters(self, stage, **counters):
+        # Rows processed, added, updated... by a stage, added up over its runs
+        with self.lock:
+            entry = self.stage_entry(stage)
+            for counter, value in counters.items():
+                entry['counters'][counter] = entry['counters'].get(counter, 0) + value
+
+    def record_call(self, service, seconds, size=0, error=False):
+        with self.lock:
+            entry = self.service_entry(service)
+            entry['calls'] = entry['calls'] + 1
+            entry['seconds'] = entry['seconds'] + seconds
+            entry['bytes'] = entry['bytes'] + size
+            if error:
+                entry['errors'] = entry['errors'] + 1
+
+    def record_retry(self, service, count=1):
+        with self.lock:
+            entry = self.service_entry(service)
+            entry['retries'] = entry['retries'] + count
+
+    @contextmanager
+    def call(self, service):
+
+        # Time one outbound call of a service, an exception counts as an error
+        start = time.time()
+        try:
+            yield
+        except BaseException:
+            self.record_call(service, time.time() - start, error=True)
+            raise
+        self.record_call(service, time.time() - start)
+
+    def execute(self, service, request):
+
+        # request.execute() of a Google API client request, with the size of the raw response body
+        # read in the postproc hook the client calls with the downloaded content
+        sizes = []
+        postproc = getattr(request, 'postproc', None)
+        if postproc is not None:
+            def measured_postproc(response, content):
+                sizes.append(len(content or b''))
+                return postproc(response, content)
+            request.postproc = measured_postproc
+
+        start = time.time()
+        try:
+            response = request.execute()
+        except BaseException:
+            self.record_call(service, time.time() - start, sum(sizes), error=True)
+            raise
+        self.record_call(service, time.time() - start, sum(sizes))
+
+        return response
+
+    def report(self, error=None):
+        # Copy of the counters, times rounded to the millisecond
+        with self.lock:
+            return {
+                'started': self.started.strftime('%Y-%m-%dT%H:%M:%S'),
+                'seconds': round(time.time() - self.start_time, 3),
+                'status': 'failed' if error is not None else 'completed',
+                'error': repr(error) if error is not None else None,
+                'stages': {name: dict(entry, seconds=round(entry['seconds'], 3), counters=dict(entry['counters']))
+                           for name, entry in self.stages.items()},
+                'services': {service: dict(entry, seconds=round(entry['seconds'], 3))
+                             for service, entry in self.services.items()}
+            }
+
+    def write_report(self, report_file=RUN_REPORT_FILE, error=None):
+
+        report = self.report(error)
+
+        with open(report_file + '.tmp', 'w') as report_output:
+            json.dump(report, report_output, indent=2, default=str)
+        os.replace(report_file + '.tmp', report_file)
+
+        for service, entry in report['services'].items():
+            logging.info('%s: %s calls, %s errors, %s retries, %s bytes in %.1f seconds'
+                         % (service, entry['calls'], entry['errors'], entry['retries'], entry['bytes'],
+                            entry['seconds']))
+        logging.info('Run report saved in %s' % report_file)
+
+
+@lru_cache(maxsize=None)
+def run_metrics():
+
+    # One set of counters for the process lifetime
+    return RunMetrics()
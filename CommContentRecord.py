@@ -0,0 +1,183 @@
+# CommContentRecord.py
+#
+# Typed record of one piece of online content, as stored in one row of the
+# Google Sheet and one feature of the ArcGIS feature layer
+
+# Standard libraries
+import sys
+import hashlib
+from datetime import datetime
+
+# Variable file
+from CommContentProcessingVariables import *
+
+
+# Text columns of the sheet, in column order
+TEXT_FIELDS = ('origin', 'post_id', 'published_date', 'post_url', 'title', 'content',
+               'photo_url', 'video_url', 'thumb_url', 'post_type', 'source')
+
+# Latitude/longitude columns, only present for sources with a location
+LOCATION_FIELDS = ('latitude', 'longitude')
+
+
+def format_coordinate(value):
+
+    # Same text as str(round(value, 7)) in the collectors, where a missing location is the integer 0
+    if value == 0:
+        return '0'
+    return str(round(value, 7))
+
+
+class ContentRecord:
+
+    # latitude/longitude are numbers rounded to 7 decimals, None when the source has no location columns (YouTube)
+    # origin, post_type and source take a handful of values and are interned
+
+    __slots__ = TEXT_FIELDS + LOCATION_FIELDS + ('_published_ms', '_fingerprint')
+
+    def __init__(self, origin, post_id, published_date, post_url, title, content,
+                 photo_url, video_url, thumb_url, post_type, source, latitude=None, longitude=None):
+        self.origin = sys.intern(origin)
+        self.post_id = post_id
+        self.published_date = published_date
+        self.post_url = post_url
+        self.title = title
+        self.content = content
+        self.photo_url = photo_url
+        self.video_url = video_url
+        self.thumb_url = thumb_url
+        self.post_type = sys.intern(post_type)
+        self.source = sys.intern(source)
+        # Coordinates are kept at the precision written in the sheet
+        self.latitude = round(latitude, 7) if latitude is not None else None
+        self.longitude = round(longitude, 7) if longitude is not None else None
+        self._published_ms = None
+        self._fingerprint = None
+
+    @classmethod
+    def from_row(cls, row):
+        # Sheet rows can be shorter than expected: trailing empty cells are not returned
+        text_values = list(row[0:len(TEXT_FIELDS)]) + [''] * (len(TEXT_FIELDS) - len(row))
+
+        if len(row) > max(ONLINE_CONTENT_LATITUDE_ROW, ONLINE_CONTENT_LONGITUDE_ROW):
+            latitude = float(row[ONLINE_CONTENT_LATITUDE_ROW] or 0)
+            longitude = float(row[ONLINE_CONTENT_LONGITUDE_ROW] or 0)
+        else:
+            latitude = None
+            longitude = None
+
+        return cls(*text_values, latitude=latitude, longitude=longitude)
+
+    @classmethod
+    def from_feature(cls, feature):
+        # Feature of the layer as built by to_feature, e.g. from FeatureSet.features
+        # The layer stores 0/0 for content without location: such records come back located at 0/0
+        attributes = feature['attributes']
+        published_date = datetime.fromtimestamp(attributes['published_date'] / 1000).strftime('%Y-%m-%dT%H:%M:%S')
+
+        return cls(attributes['origin'], attributes['post_id'], published_date, attributes['post_url'],
+                   attributes['title'], attributes['content'], attributes['photo_url'], attributes['video_url'],
+                   attributes['thumb_url'], attributes['post_type'], attributes['source'],
+                   latitude=attributes['latitude'] or 0, longitude=attributes['longitude'] or 0)
+
+    @property
+    def has_location(self):
+        return self.latitude is not None
+
+    @property
+    def is_located(self):
+        # Geolocated content: location columns present and not 0/0
+        return self.has_location and (self.latitude != 0 or self.longitude != 0)
+
+    @property
+    def published_ms(self):
+        # Published date in milliseconds since epoch, parsed once
+        if self._published_ms is None:
+            date = self.published_date
+            self._published_ms = int(datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                                              int(date[11:13]), int(date[14:16]),
+                                              int(date[17:19])).timestamp() * 1000)
+        return self._published_ms
+
+    @property
+    def fingerprint(self):
+        # Hash of the values as written in the sheet, computed once: same fingerprint, same content
+        if self._fingerprint is None:
+            values = '\x1f'.join(self.field_text(field) or '' for field in TEXT_FIELDS + LOCATION_FIELDS)
+            self._fingerprint = hashlib.blake2b(values.encode('utf-8'), digest_size=16).hexdigest()
+        return self._fingerprint
+
+    def text_values(self):
+        return tuple(getattr(self, field) for field in TEXT_FIELDS)
+
+    def diff(self, other):
+        # Names of the fields of this record that differ from other
+        # Location is only compared when this record has one, as the sheet keeps the old cells otherwise
+        if self.text_values() == other.text_values() and \
+                (not self.has_location or (self.latitude, self.longitude) == (other.latitude, other.longitude)):
+            return []
+
+        fields = TEXT_FIELDS + LOCATION_FIELDS if self.has_location else TEXT_FIELDS
+        return [field for field in fields if getattr(self, field) != getattr(other, field)]
+
+    def merged_with(self, other):
+        # This record as it will read in the sheet once written over the row of other
+        if self.has_location or not other.has_location:
+            return self
+
+        return ContentRecord(*self.text_values(), latitude=other.latitude, longitude=other.longitude)
+
+    def to_row(self):
+        row = list(self.text_values())
+        if self.has_location:
+            row.append(format_coordinate(self.latitude))
+            row.append(format_coordinate(self.longitude))
+        return row
+
+    def field_text(self, field):
+        value = getattr(self, field)
+        if field in LOCATION_FIELDS and value is not None:
+            return format_coordinate(value)
+        return value
+
+    def to_feature(self, geometry=(0, 0)):
+        # geometry: Web Mercator (x, y) of the record, 0/0 when it is not geolocated
+        if self.is_located:
+            longitude_gcs = self.longitude
+            latitude_gcs = self.latitude
+        else:
+            geometry = (0, 0)
+            longitude_gcs = 0
+            latitude_gcs = 0
+
+        return {
+            'attributes': {
+                'origin': self.origin,
+                'post_id': self.post_id,
+                'published_date': self.published_ms,
+                'post_url': self.post_url,
+                'title': self.title,
+                'content': self.content,
+                'photo_url': self.photo_url,
+                'video_url': self.video_url,
+                'thumb_url': self.thumb_url,
+                'post_type': self.post_type,
+                'source': self.source,
+                'latitude': latitude_gcs,
+                'longitude': longitude_gcs
+            },
+            'geometry': {
+                'x': geometry[0],
+                'y': geometry[1]
+            }
+        }
+
+    def __eq__(self, other):
+        return isinstance(other, ContentRecord) and self.text_values() == other.text_values() and \
+            (self.latitude, self.longitude) == (other.latitude, other.longitude)
+
+    def __hash__(self):
+        return hash((self.text_values(), self.latitude, self.longitude))
+
+    def __repr__(self):
+        return 'ContentRecord(%s, %s, %s)' % (self.source, self.post_id, self.published_date)
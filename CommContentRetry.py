@@ -0,0 +1,189 @@
+# CommContentRetry.py
+#
+# Shared execution of the calls to the external services: exponential backoff
+# with jitter on transient errors (429, 5xx, timeouts, dropped connections),
+# Retry-After honoured, and one token bucket per service to stay under its quota
+
+# Standard libraries
+import re
+import sys
+import time
+import random
+import socket
+import logging
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+
+# Default settings, can be overridden in the variable file
+RETRY_MAX_ATTEMPTS = 5  # Attempts of a call before its error is raised
+RETRY_BASE_DELAY = 1.0  # Seconds before the first retry, doubled at each attempt
+RETRY_MAX_DELAY = 60.0  # Longest wait between two attempts, unless the service asks for more with Retry-After
+RETRY_STATUSES = [429, 500, 502, 503, 504]  # HTTP statuses worth another attempt
+# Requests per second and burst allowed to each service, matched to the API quotas:
+# Sheets 60 requests per minute per user, YouTube and Blogger per 100 seconds quotas,
+# Wordpress and Tchop kept gentle, ArcGIS Enterprise on our own portal
+SERVICE_RATE_LIMITS = {
+    'Sheets': (1.0, 5),
+    'YouTube': (10.0, 10),
+    'Blogger': (10.0, 10),
+    'Wordpress': (8.0, 8),
+    'Tchop': (5.0, 5),
+    'ArcGIS': (5.0, 5)
+}
+
+# Variable file
+from CommContentProcessingVariables import *
+
+# Run instrumentation
+from CommContentMetrics import run_metrics
+
+
+class TokenBucket:
+
+    # rate tokens added per second, up to capacity: a call takes one token, waiting for it if needed
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+# Each bucket is created once even when several threads call a service for the first time together,
+# e.g. the Wordpress page downloads
+bucket_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def rate_bucket(service):
+
+    # One bucket per service for the process lifetime, shared by all the threads calling it
+    rate, capacity = SERVICE_RATE_LIMITS.get(service, (None, None))
+    if rate is None:
+        return None
+    return TokenBucket(rate, capacity)
+
+
+def service_bucket(service):
+
+    with bucket_lock:
+        return rate_bucket(service)
+
+
+def retry_after_seconds(value):
+
+    # Retry-After is either a number of seconds or an HTTP date
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def transient_error(error):
+
+    # (retry, retry_after, rate_limited) for an error raised by a call
+    # rate_limited errors were refused before doing anything and can always be sent again
+    # The client libraries are looked up rather than imported: their errors can only be raised once they are loaded
+    google_errors = sys.modules.get('googleapiclient.errors')
+    requests = sys.modules.get('requests')
+
+    if google_errors is not None and isinstance(error, google_errors.HttpError):
+        status = int(error.resp.status)
+        retry_after = retry_after_seconds(error.resp.get('retry-after'))
+        # Google also says 403 when a per user rate limit is exceeded
+        rate_limited = status == 429 or (status == 403 and b'ratelimitexceeded' in (error.content or b'').lower())
+        return rate_limited or status in RETRY_STATUSES, retry_after, rate_limited
+
+    if requests is not None and isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        retry_after = retry_after_seconds(error.response.headers.get('Retry-After'))
+        return status in RETRY_STATUSES, retry_after, status == 429
+
+    if isinstance(error, (ConnectionError, TimeoutError, socket.timeout)) or \
+            (requests is not None and isinstance(error, (requests.ConnectionError, requests.Timeout))):
+        return True, None, False
+
+    # ArcGIS API errors are plain exceptions carrying the REST error code in the message
+    match = re.search(r'Error Code: (\d+)', str(error))
+    if match is not None:
+        status = int(match.group(1))
+        return status in RETRY_STATUSES, None, status == 429
+
+    return False, None, False
+
+
+def backoff_delay(attempt, retry_after=None):
+
+    # Full jitter: a random wait up to the exponential delay, never less than what the service asked
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def call_with_retry(service, function, *args, idempotent=True, max_attempts=RETRY_MAX_ATTEMPTS, **kwargs):
+
+    # Call function(*args, **kwargs) within the rate of the service, again on transient errors
+    # A call that is not idempotent (e.g. appending rows) is only sent again when the service
+    # refused it for rate limiting: after a 5xx or a timeout it may have been applied already
+    bucket = service_bucket(service)
+    attempt = 0
+
+    while True:
+        if bucket is not None:
+            bucket.acquire()
+
+        try:
+            return function(*args, **kwargs)
+        except Exception as error:
+            retry, retry_after, rate_limited = transient_error(error)
+            attempt = attempt + 1
+
+            if not retry or (not idempotent and not rate_limited) or attempt >= max_attempts:
+                raise
+
+            delay = backoff_delay(attempt - 1, retry_after)
+            logging.warning('%s call failed (%s), attempt %s of %s in %.1f seconds'
+                            % (service, error, attempt + 1, max_attempts, delay))
+            run_metrics().record_retry(service)
+            time.sleep(delay)
+
+
+def execute(service, request, idempotent=True):
+
+    # request.execute() of a Google API client request, counted in the run report
+    return call_with_retry(service, run_metrics().execute, service, request, idempotent=idempotent)
+
+
+def call_service(service, function, *args, idempotent=True, **kwargs):
+
+    # Any other call of a service, e.g. an ArcGIS edit, timed in the run report
+    def timed_call():
+        with run_metrics().call(service):
+            return function(*args, **kwargs)
+
+    return call_with_retry(service, timed_call, idempotent=idempotent)
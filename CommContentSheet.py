@@ -0,0 +1,332 @@
+# CommContentSheet.py
+#
+# Google Sheet stage: in-memory index of the sheet rows, reconciliation of the
+# harvested rows with the sheet and batched writes of the changes
+
+# Standard libraries
+import bisect
+import logging
+
+# Default settings, can be overridden in the variable file
+SHEET_BATCH_SIZE = 500  # Maximum number of rows sent in a single Google Sheet request
+SHEET_INSERT_MODE = 'append'  # 'append' new rows at the end, or 'ordered' to insert them at their sorted position
+
+# Variable file
+from CommContentProcessingVariables import *
+
+# Content rows
+from CommContentRecord import ContentRecord
+
+# Run instrumentation
+from CommContentMetrics import run_metrics
+
+# Retries and rate limits of the external services
+from CommContentRetry import execute
+
+
+def chunks(items, size):
+
+    # Split a list into consecutive slices of at most size elements
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class SheetIndex:
+
+    # In-memory view of the Google Sheet rows as ContentRecord, keyed by post_id
+    # Built once from the values downloaded in main() and kept up to date
+    # while rows are appended, updated or sorted during the run
+    # dirty holds the post_ids of the rows added or changed since the sheet was read
+
+    def __init__(self, values):
+        self.rows = []
+        self.positions = {}
+        self.dirty = set()
+
+        for value in values:
+            self.append(ContentRecord.from_row(value))
+
+        # Rows read from the sheet are clean
+        self.dirty.clear()
+
+    @classmethod
+    def from_records(cls, records):
+        # Index of rows already known as records, e.g. loaded from the content store, in sheet order
+        sheet_index = cls([])
+        for record in records:
+            sheet_index.append(record)
+        sheet_index.dirty.clear()
+        return sheet_index
+
+    def __contains__(self, post_id):
+        return post_id in self.positions
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, post_id):
+        return self.rows[self.positions[post_id]]
+
+    def row_number(self, post_id):
+        # Add the header rows to the position in the list to get the row in the sheet
+        return self.positions[post_id] + ONLINE_CONTENT_FIRST_POST_ROW
+
+    def append(self, record):
+        # If a post_id is duplicated in the sheet, the first row wins as list.index() did
+        self.positions.setdefault(record.post_id, len(self.rows))
+        self.rows.append(record)
+        self.dirty.add(record.post_id)
+
+    def update(self, post_id, record):
+        position = self.positions[post_id]
+        # Location cells are not overwritten in the sheet by a record without location
+        self.rows[position] = record.merged_with(self.rows[position])
+        self.dirty.add(post_id)
+
+    def rebuild_positions(self):
+        self.positions = {}
+        for position, record in enumerate(self.rows):
+            self.positions.setdefault(record.post_id, position)
+
+    def is_sorted(self, end=None):
+        # Whether the rows (up to end) are in published date order, i.e. the sort request would not move anything
+        rows = self.rows[:end]
+        return all(rows[idx].published_date <= rows[idx + 1].published_date for idx in range(len(rows) - 1))
+
+    def sort_by_published_date(self):
+        # Same order as the sortRange request on the sheet: stable and ascending on the date text
+        self.rows.sort(key=lambda record: record.published_date)
+        self.rebuild_positions()
+
+    def place_new_rows(self, count):
+        # Move the last count rows, appended since the last flush, to their sorted position
+        # The other rows must be in order: each new row goes after the rows of the same date,
+        # where the sortRange request would have put it
+        old_rows = self.rows[:len(self.rows) - count]
+        new_rows = sorted(self.rows[len(self.rows) - count:], key=lambda record: record.published_date)
+        dates = [record.published_date for record in old_rows]
+
+        self.rows = []
+        new_positions = []
+        start = 0
+        for record in new_rows:
+            position = bisect.bisect_right(dates, record.published_date)
+            self.rows.extend(old_rows[start:position])
+            start = position
+            new_positions.append(len(self.rows))
+            self.rows.append(record)
+        self.rows.extend(old_rows[start:])
+
+        self.rebuild_positions()
+
+        # Final positions of the new rows, in ascending order
+        return new_positions
+
+    def records(self, post_ids=None):
+        # Records of the given post_ids, or of every row of the sheet
+        if post_ids is None:
+            return list(self.rows)
+        return [self.get(post_id) for post_id in post_ids if post_id in self]
+
+
+def read_sheet_post_ids(sheet):
+
+    # Only the post_id column (B) of the sheet, in sheet order: a small part of the whole table
+    post_id_range = '%s!B%s:B' % (ONLINE_CONTENT_RANGE_NAME.split('!')[0], ONLINE_CONTENT_FIRST_POST_ROW)
+    result = execute('Sheets', sheet.values().get(spreadsheetId=ONLINE_CONTENT_SPREADSHEET_ID, range=post_id_range))
+
+    return [row[0] if len(row) > 0 else '' for row in result.get('values', [])]
+
+
+def load_sheet_index(sheet, store, full_sheet_read=False):
+
+    # The rows are loaded from the content store when it was saved after the last change of the sheet,
+    # only the post_id column is read to make sure no row was added, removed or moved by hand
+    if store.sheet_in_sync() and not full_sheet_read:
+        store_records = store.sheet_records()
+        if read_sheet_post_ids(sheet) == [record.post_id for record in store_records]:
+            logging.info('### All current values loaded from the content store')
+            return SheetIndex.from_records(store_records)
+
+        logging.info('### Content store differs from the Google Sheet')
+
+    get_request = sheet.values().get(spreadsheetId=ONLINE_CONTENT_SPREADSHEET_ID, range=ONLINE_CONTENT_RANGE_NAME)
+    result = execute('Sheets', get_request)
+    values = result.get('values', [])
+
+    logging.info('### All current values recovered')
+
+    # Index all rows by post ID
+    sheet_index = SheetIndex(values)
+
+    # The sheet is the reference: rows changed by hand become pending for the layer
+    store.save_sheet(sheet_index)
+    logging.info('### Content store updated from the Google Sheet')
+
+    return sheet_index
+
+
+def insert_sheet_rows(sheet, positions, batch_size=SHEET_BATCH_SIZE):
+
+    # Insert empty rows at the given final positions (ascending), consecutive positions in one request
+    # Requests are applied in order: once the rows above are inserted, each position is the final one
+    runs = []
+    for position in positions:
+        if len(runs) > 0 and runs[-1][1] == position:
+            runs[-1][1] = position + 1
+        else:
+            runs.append([position, position + 1])
+
+    for batch in chunks(runs, batch_size):
+        insert_requests = [{
+            "insertDimension": {
+                "range": {
+                    "sheetId": 0,
+                    "dimension": 'ROWS',
+                    "startIndex": ONLINE_CONTENT_SORT_START_ROW_INDEX + start,
+                    "endIndex": ONLINE_CONTENT_SORT_START_ROW_INDEX + end
+                },
+                "inheritFromBefore": start > 0
+            }
+        } for start, end in batch]
+
+        # Not sent again after a server error: the rows may have been inserted already
+        execute('Sheets', sheet.batchUpdate(spreadsheetId=ONLINE_CONTENT_SPREADSHEET_ID,
+                                            body={"requests": insert_requests}), idempotent=False)
+
+        logging.info('%s rows inserted in one batch' % sum(end - start for start, end in batch))
+
+
+def send_sheet_changes(sheet, sheet_index, post_ids_to_add, post_ids_to_update, batch_size=SHEET_BATCH_SIZE,
+                       insert_mode=SHEET_INSERT_MODE):
+
+    # post_ids_to_add are the last rows of sheet_index, post_ids_to_update the rows changed since the last flush
+    # Values and row numbers are only looked up here, once the new rows have found their place
+    post_ids_to_write = list(post_ids_to_update)
+
+    if len(post_ids_to_add) > 0 and insert_mode == 'ordered' and \
+            sheet_index.is_sorted(end=len(sheet_index) - len(post_ids_to_add)):
+        # New rows: empty rows inserted at their sorted position, then written with the updates
+        insert_sheet_rows(sheet, sheet_index.place_new_rows(len(post_ids_to_add)), batch_size)
+        post_ids_to_write = list(post_ids_to_add) + post_ids_to_write
+
+    else:
+        # New rows: appended in bulk at the end of the table
+        # Sent first so that updates of rows added during this run land on the right row
+        for batch_post_ids in chunks(list(post_ids_to_add), batch_size):
+            batch = [sheet_index.get(post_id).to_row() for post_id in batch_post_ids]
+            value_range_body = {
+                "range": ONLINE_CONTENT_RANGE_NAME,
+                "majorDimension": 'ROWS',
+                "values": batch
+            }
+
+            append_request = sheet.values().append(spreadsheetId=ONLINE_CONTENT_SPREADSHEET_ID,
+                                                   range=ONLINE_CONTENT_RANGE_NAME,
+                                                   valueInputOption='RAW',
+                                                   insertDataOption='INSERT_ROWS',
+                                                   body=value_range_body)
+            # Not sent again after a server error: the rows may have been appended already
+            execute('Sheets', append_request, idempotent=False)
+
+            logging.info('%s rows appended in one batch' % len(batch))
+
+    # Changed rows: one values().batchUpdate call per chunk of ranges
+    for batch_post_ids in chunks(post_ids_to_write, batch_size):
+        batch = []
+        for post_id in batch_post_ids:
+            # Row to update, taking into account the header rows of the sheet
+            row_to_update = sheet_index.row_number(post_id)
+            update_range = ONLINE_CONTENT_UPDATE_RANGE % (row_to_update, row_to_update)
+
+            batch.append({
+                "range": update_range,
+                "majorDimension": 'ROWS',
+                "values": [
+                    sheet_index.get(post_id).to_row()
+                ]
+            })
+
+        batch_update_body = {
+            "valueInputOption": 'RAW',
+            "data": batch
+        }
+
+        update_request = sheet.values().batchUpdate(spreadsheetId=ONLINE_CONTENT_SPREADSHEET_ID,
+                                                    body=batch_update_body)
+        response = execute('Sheets', update_request)
+
+        logging.info('%s rows updated in one batch' % response.get('totalUpdatedRows', len(batch)))
+
+
+def update_google_sheet(sheet, sheet_index, content_list, batch_size=SHEET_BATCH_SIZE, insert_mode=SHEET_INSERT_MODE):
+
+    # content_list can be any iterable of rows, e.g. the stream of rows of the collectors
+    counter_processed = 0
+    counter_added = 0
+    counter_updated = 0
+    counter_unchanged = 0
+
+    # Changes are gathered and sent in a few batched requests each time a batch is full
+    # Ordered sets of post_ids, the values are read from sheet_index when the changes are sent
+    post_ids_to_add = {}
+    post_ids_to_update = {}
+
+    for content in content_list:
+
+        unique_id = content.post_id
+
+        # If new information append to list
+        if unique_id not in sheet_index:
+            post_ids_to_add[unique_id] = True
+            sheet_index.append(content)
+            counter_added = counter_added + 1
+
+            logging.info('Post id %s added' % content.post_id)
+            print('Post id %s added' % content.post_id)
+
+        # If already existing information, update content
+        else:
+
+            current_values = sheet_index.get(unique_id)
+            changed_fields = content.diff(current_values)
+
+            if len(changed_fields) > 0:
+
+                # A post seen twice in the same run only needs its last version written
+                if unique_id not in post_ids_to_add:
+                    post_ids_to_update[unique_id] = True
+                sheet_index.update(unique_id, content)
+
+                counter_updated = counter_updated + 1
+
+                logging.info('Post id %s updated' % unique_id)
+                for field in changed_fields:
+                    logging.info('Field %s updated' % field)
+                    logging.info('Old value: %s' % current_values.field_text(field))
+                    logging.info('New value: %s' % content.field_text(field))
+
+                print('Post id %s updated' % unique_id)
+
+            else:
+                counter_unchanged = counter_unchanged + 1
+                # print('ID already exists and same information, No update')
+
+        counter_processed = counter_processed + 1
+
+        if len(post_ids_to_add) + len(post_ids_to_update) >= batch_size:
+            send_sheet_changes(sheet, sheet_index, post_ids_to_add, post_ids_to_update, batch_size, insert_mode)
+            post_ids_to_add = {}
+            post_ids_to_update = {}
+
+    send_sheet_changes(sheet, sheet_index, post_ids_to_add, post_ids_to_update, batch_size, insert_mode)
+
+    logging.info('Processed: %s, Added: %s, Updated: %s, Unchanged: %s'
+                 % (counter_processed, counter_added, counter_updated, counter_unchanged))
+    print('Processed: %s, Added: %s, Updated: %s, Unchanged: %s'
+          % (counter_processed, counter_added, counter_updated, counter_unchanged))
+
+    run_metrics().add_counters('Google Sheet update', processed=counter_processed, added=counter_added,
+                               updated=counter_updated, unchanged=counter_unchanged)
+
+    return counter_processed, counter_added, counter_updated, counter_unchanged
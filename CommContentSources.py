@@ -0,0 +1,736 @@
+# CommContentSources.py
+#
+# Source harvesting stage: collectors of Tchop, YouTube, Blogger and Wordpress,
+# normalization of their posts into content rows, incremental sync marks and
+# the concurrent harvest of the four sources
+
+# Standard libraries
+import os
+import json
+import logging
+import re
+import time
+import threading
+import queue
+from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Default settings, can be overridden in the variable file
+SOURCE_TIMEOUT = 1800  # Seconds allowed to harvest one source
+SOURCE_TIMEOUTS = {}  # Per source timeouts, e.g. {'Wordpress': 600}
+SYNC_STATE_FILE = 'sync-state.json'  # Per source high-water marks for incremental sync
+SYNC_OVERLAP_HOURS = 24  # Hours read again before each mark to absorb time zone differences
+# Sources whose edited content cannot be requested are read in full every few days to pick up the edits
+SYNC_FULL_READ_DAYS = {'YouTube': 7}
+WORDPRESS_PER_PAGE = 100  # Posts per Wordpress REST API page, 100 at most
+WORDPRESS_WORKERS = 4  # Wordpress pages downloaded at the same time
+WORDPRESS_MAX_PENDING = 8  # Wordpress pages downloaded ahead of the sheet update
+NORMALIZE_CHUNK_SIZE = 200  # Posts sent to a worker process at once
+NORMALIZE_MAX_PENDING = 8  # Chunks being normalized ahead of the sheet update
+HARVEST_QUEUE_SIZE = 20  # Batches of rows a source can download ahead of the sheet update
+
+# Variable file
+from CommContentProcessingVariables import *
+
+# Shared HTTP layer
+from CommContentHttp import shared_http_cache
+
+# Wordpress post locations
+from CommContentLocations import wordpress_locations
+
+# Post body extraction
+from CommContentHtml import summarize_html
+
+# Content rows
+from CommContentRecord import ContentRecord
+
+# Run instrumentation
+from CommContentMetrics import run_metrics
+
+# Retries and rate limits of the external services
+from CommContentRetry import execute
+
+# Google API clients
+from CommContentGoogle import google_service_init
+
+
+def get_data(service_url, token, skip_unchanged=False):
+    payload = {
+        'token': token,
+        'f': 'json'
+    }
+
+    feature_response = shared_http_cache().get(service_url, params=payload, service='Tchop')
+
+    # With skip_unchanged, a stream unchanged since a run that saved it in the sheet is not parsed again
+    if skip_unchanged and feature_response.confirmed:
+        logging.info('Unchanged response from %s' % service_url)
+        return []
+
+    json_string = feature_response.text
+    pydict = json.loads(json_string)
+
+    return pydict
+
+
+def normalize_chunk(normalizer, *item_lists):
+
+    # Run in the worker processes: module level so that it can be pickled
+    return list(map(normalizer, *item_lists))
+
+
+def normalize_pages(normalizer, pages, pool=None, chunk_size=NORMALIZE_CHUNK_SIZE,
+                    max_pending=NORMALIZE_MAX_PENDING):
+
+    # pages: iterable of tuples of item lists, one list per normalizer argument
+    # Yields the normalized rows chunk by chunk, in page order
+    # With a process pool, up to max_pending chunks are normalized while the next pages download
+    pending = deque()
+
+    for item_lists in pages:
+        for start in range(0, len(item_lists[0]), chunk_size):
+            chunk_lists = [item_list[start:start + chunk_size] for item_list in item_lists]
+
+            if pool is None:
+                yield normalize_chunk(normalizer, *chunk_lists)
+            else:
+                pending.append(pool.submit(normalize_chunk, normalizer, *chunk_lists))
+                while len(pending) > max_pending:
+                    yield pending.popleft().result()
+
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def normalize_tchop_card(card):
+
+    # print(card)
+    card_id = str(card['id'])
+    card_type = card['type']
+    card_posted_time = card['postedTime'][0:19]
+
+    card_url = ''
+    card_video_url = ''
+    card_image_url = ''
+    card_title = ''
+    card_headline = ''
+    card_text = ''
+
+    if card_type in ['image', 'video']:
+        card_title = card['title']
+        if card_title is None:
+            card_title = ''
+
+        card_headline = card['headline']
+
+        card_text = card['text']
+        if card_text is None:
+            card_text = ''
+
+        if card_type == 'image':
+            card_image_url = card['image']['phone']['jpg']
+        elif card_type == 'video':
+            card_video_url = card['video']['url']
+        card_exif = card[card_type]['exif']
+
+    elif card_type == 'quote':
+        card_url = card['url']
+        card_headline = card['quotePerson']
+        card_text = card['quote']
+
+        if 'image' in card:
+            card_image_url = card['image']['phone']['jpg']
+            card_exif = card['image']['exif']
+        else:
+            card_image_url = ''
+            card_exif = ''
+
+    elif card_type == 'article':
+        card_url = card['url']
+        card_headline = card['title']
+        card_text = card['abstract']
+
+        if 'image' in card:
+            card_image_url = card['image']['phone']['jpg']
+            card_exif = card['image']['exif']
+        else:
+            card_image_url = ''
+            card_exif = ''
+
+    # print('id: %s, type: %s, headline: %s' % (card_id, card_type, card_headline))
+
+    if len(card_title) > len(card_text):
+        card_text = card_title
+
+    # print(card_id)
+    # print(len(card_exif))
+
+    if len(card_exif) == 1:
+        latitude = card_exif['gps']['latitude']
+        longitude = card_exif['gps']['longitude']
+    else:
+        latitude = 0
+        longitude = 0
+
+    # change card type from image to photo
+    if card_type == 'image':
+        card_type = 'photo'
+
+    downloaded_values = ContentRecord(
+        'Tchop Download Script',                    # __PowerAppsId__
+        card_id,                                    # post_id
+        card_posted_time,                           # published_date
+        card_url,                                   # post_url
+        re.sub('[^\x00-\x7f]', '', card_headline),  # title
+        re.sub('[^\x00-\x7f]', '', card_text),      # content
+        card_image_url,                             # photo_url
+        card_video_url,                             # video_url
+        card_image_url,                             # thumb_url
+        card_type,                                  # type
+        'Tchop',                                    # source
+        latitude,                                   # latitude
+        longitude                                   # longitude
+        )
+
+    return downloaded_values
+
+
+def process_tchop(dump, pool=None):
+
+    # mix_id = mix['id']
+    # mix_title = mix['title']
+    # mix_subtitle = mix['subtitle']
+
+    return normalize_pages(normalize_tchop_card, ((mix['cards'],) for mix in dump), pool)
+
+
+def normalize_youtube_video(video):
+
+    # video: resource given by videos().list
+    video_id = video["id"]
+    post_url = 'https://www.youtube.com/watch?v=%s' % video_id
+    video_url = 'https://www.youtube.com/embed/%s?wmode=opaque#isVideo' % video_id
+    title = video["snippet"]["title"]
+    thumbnail = video["snippet"]["thumbnails"]["medium"]["url"]
+    description = video["snippet"]["description"]
+    published_date = video["snippet"]["publishedAt"][0:19]
+
+    # location_info = youtube.videos().list(part='recordingDetails', id=video_id).execute()
+    # try:
+    #     latitude = location_info["recordingDetails"]["location"]["latitude"]
+    #     longitude = location_info["recordingDetails"]["location"]["longitude"]
+    #     # print(latitude, longitude)
+    # except:
+    #     # print('NO LOCATION INFORMATION AVAILABLE')
+    #     latitude = '0'
+    #     longitude = '0'
+
+    # Latitude/longitude will never be available from YouTube
+    downloaded_values = ContentRecord(
+        'YouTube Download Script',  # __PowerAppsId__
+        video_id,                   # post_id
+        published_date,             # published_date
+        post_url,                   # post_url
+        title,                      # title
+        description,                # content
+        '',                         # photo_url
+        video_url,                  # video_url
+        thumbnail,                  # thumb_url
+        'video',                    # type
+        'YouTube'                   # source
+    )
+
+    return downloaded_values
+
+
+def youtube_uploads_playlist(youtube, channel_id):
+
+    # Every video uploaded to a channel is in its uploads playlist
+    channels_response = execute('YouTube', youtube.channels().list(part='contentDetails', id=channel_id))
+
+    return channels_response['items'][0]['contentDetails']['relatedPlaylists']['uploads']
+
+
+def fetch_youtube_video_ids(youtube, playlist_id, published_after=None):
+
+    # Pages of video ids of the playlist, 1 quota unit per page of 50 where a search costs 100
+    # The uploads playlist lists the most recent videos first: with published_after, paging stops
+    # at the first page where every video was published before it
+    published_after_text = published_after.strftime('%Y-%m-%dT%H:%M:%S') if published_after is not None else ''
+
+    playlist_items = youtube.playlistItems()
+    request = playlist_items.list(playlistId=playlist_id, part='contentDetails', maxResults=50)
+
+    while request is not None:
+        response = execute('YouTube', request)
+
+        # Private or deleted videos have no videoPublishedAt, they are left to videos().list
+        video_ids = [item['contentDetails']['videoId'] for item in response['items']
+                     if item['contentDetails'].get('videoPublishedAt', '9999')[0:19] >= published_after_text]
+        yield video_ids
+
+        if published_after is not None and len(video_ids) == 0:
+            break
+
+        request = playlist_items.list_next(request, response)
+
+
+def process_youtube(youtube, channel_id, published_after=None):
+
+    # Retrieve the list of videos uploaded to the Unicef Malawi channel.
+    uploads_playlist = youtube_uploads_playlist(youtube, channel_id)
+
+    for video_ids in fetch_youtube_video_ids(youtube, uploads_playlist, published_after):
+        if len(video_ids) == 0:
+            continue
+
+        # Details of up to 50 videos in a single call
+        # The channel owner also sees its private and unlisted videos: only public ones are published
+        videos_response = execute('YouTube', youtube.videos().list(part='snippet,status', id=','.join(video_ids)))
+
+        # Rows of each page are given as soon as the page is downloaded
+        yield [normalize_youtube_video(video) for video in videos_response['items']
+               if video['status']['privacyStatus'] == 'public']
+
+
+def normalize_blogger_post(post):
+
+    post_id = post['id']
+    published_date = post['published'][0:19]
+    post_url = post['url']
+    title = post['title']
+
+    # Start of the text and first link/iframe, in a single pass over the post
+    blog_content = summarize_html(post['content'], text_length=150, media='links')
+
+    content = blog_content.text.replace('\n', ' ') + '...'
+
+    if blog_content.has_link:
+        photo_url = blog_content.link
+        thumb_url = blog_content.link
+        video_url = ''
+        post_type = 'photo'
+    elif blog_content.has_iframe:
+        video_url = blog_content.iframe_src
+        thumb_url = blog_content.iframe_thumbnail
+        photo_url = ''
+        post_type = 'video'
+    else:
+        video_url = 'NO INFO'
+        thumb_url = 'NO INFO'
+        photo_url = 'NO INFO'
+        post_type = 'no_info'
+
+    try:
+        latitude = post['location']['lat']
+        longitude = post['location']['lng']
+    except:
+        latitude = 0
+        longitude = 0
+
+    downloaded_values = ContentRecord(
+        'Blogger Download Script',  # __PowerAppsId__
+        post_id,                    # post_id
+        published_date,             # published_date
+        post_url,                   # post_url
+        title,                      # title
+        content.lstrip(),           # content
+        photo_url,                  # photo_url
+        video_url,                  # video_url
+        thumb_url,                  # thumb_url
+        post_type,                  # type
+        'Blogger',                  # source
+        latitude,                   # latitude
+        longitude                   # longitude
+    )
+
+    return downloaded_values
+
+
+def fetch_blogger_pages(blogger, blog_id, updated_after=None, modified_dates=None):
+
+    posts = blogger.posts()
+
+    # Most recently updated posts first, so that posts edited since the last run are read too
+    list_parameters = {
+        'blogId': blog_id,
+        'maxResults': 50,
+        'orderBy': 'updated'
+    }
+
+    # Incremental sync: paging stops at the first page where every post was updated before updated_after
+    updated_after_text = updated_after.strftime('%Y-%m-%dT%H:%M:%S') if updated_after is not None else ''
+
+    request = posts.list(**list_parameters)
+    while request is not None:
+        posts_doc = execute('Blogger', request)
+
+        items = [post for post in posts_doc.get('items') or [] if post['updated'][0:19] >= updated_after_text]
+        if len(items) > 0:
+            # The update date of the posts is the mark of the next run
+            if modified_dates is not None:
+                modified_dates['Blogger'] = max([modified_dates.get('Blogger', '')] +
+                                                [post['updated'][0:19] for post in items])
+            yield (items,)
+        elif updated_after is not None:
+            break
+
+        request = posts.list_next(request, posts_doc)
+
+
+def process_blogger(blogger, blog_id, updated_after=None, pool=None, modified_dates=None):
+
+    # Posts of a page are normalized while the next page downloads
+    return normalize_pages(normalize_blogger_post,
+                           fetch_blogger_pages(blogger, blog_id, updated_after, modified_dates), pool)
+
+
+def fetch_wordpress_pages(wordpress, modified_after=None, workers=WORDPRESS_WORKERS,
+                          max_pending=WORDPRESS_MAX_PENDING, modified_dates=None):
+
+    # Only the fields mapped to the sheet are requested, and the modification date for the mark
+    query_parameters = {
+        'page': 1,
+        'per_page': WORDPRESS_PER_PAGE,
+        '_fields': 'id,date,modified,link,title,excerpt,content'
+    }
+
+    # Incremental sync: only posts published or edited since the last run
+    if modified_after is not None:
+        query_parameters['modified_after'] = modified_after.strftime('%Y-%m-%dT%H:%M:%S')
+
+    # The pages of an incremental sync are asked with a different date at each run, only the pages
+    # of a full read can be revalidated by the next one
+    cache = modified_after is None
+
+    def fetch_page(page):
+        response = shared_http_cache().get(wordpress, params=dict(query_parameters, page=page), service='Wordpress',
+                                           cache=cache)
+        response.raise_for_status()
+        return json.loads(response.text)
+
+    def note_modified(page_posts):
+        # The modification date of the posts is the mark of the next run
+        if modified_dates is not None and len(page_posts) > 0:
+            modified_dates['Wordpress'] = max([modified_dates.get('Wordpress', '')] +
+                                              [post['modified'][0:19] for post in page_posts])
+        return page_posts
+
+    first_response = shared_http_cache().get(wordpress, params=query_parameters, service='Wordpress', cache=cache)
+    first_response.raise_for_status()
+    yield note_modified(json.loads(first_response.text))
+
+    if 'X-WP-TotalPages' in first_response.headers:
+        # The first page gives the number of pages: fetch the others at the same time,
+        # up to max_pending pages ahead of the one being read, whatever the size of the archive
+        total_pages = int(first_response.headers['X-WP-TotalPages'])
+        logging.info('Wordpress: %s posts on %s pages' % (first_response.headers.get('X-WP-Total'), total_pages))
+
+        next_page = 2
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Pages are given in page order, a new download starts as each one is given
+            while len(pending) > 0 or next_page <= total_pages:
+                while len(pending) < max_pending and next_page <= total_pages:
+                    pending.append(executor.submit(fetch_page, next_page))
+                    next_page = next_page + 1
+                yield note_modified(pending.popleft().result())
+    else:
+        # No pagination headers: walk the pages until the API says there are no more,
+        # with a 400 past the last page, any other error stops the source instead of truncating it
+        page = 2
+        response = shared_http_cache().get(wordpress, params=dict(query_parameters, page=page), service='Wordpress',
+                                           cache=cache)
+        while response.status_code != 400:
+            response.raise_for_status()
+            page_posts = json.loads(response.text)
+            if len(page_posts) == 0:
+                break
+            yield note_modified(page_posts)
+            page = page + 1
+            response = shared_http_cache().get(wordpress, params=dict(query_parameters, page=page),
+                                               service='Wordpress', cache=cache)
+
+
+def normalize_wordpress_post(post, location):
+
+    post_id = post['id']
+    published_date = post['date'][0:19]
+    post_url = post['link']
+    title = post['title']['rendered']
+
+    # Using the excerpt field for content
+    blog_excerpt = summarize_html(post['excerpt']['rendered'], text_length=150)
+    content = blog_excerpt.text.replace('\n', ' ') + '...'
+
+    post_type = 'photo'
+
+    # Only the first image of the content is needed
+    blog_content = summarize_html(post['content']['rendered'], text_length=0, media='image')
+    photo_url = blog_content.image if blog_content.image is not None else ''
+    thumb_url = photo_url
+
+    # Latitude/longitude found in the location table, None if the post has no location
+    if location is not None:
+        latitude = location[0]
+        longitude = location[1]
+    else:
+        latitude = 0
+        longitude = 0
+
+    downloaded_values = ContentRecord(
+        'Wordpress Download Script',    # __PowerAppsId__
+        str(post_id),                   # post_id
+        published_date,                 # published_date
+        post_url,                       # post_url
+        title,                          # title
+        content.lstrip(),               # content
+        photo_url,                      # photo_url
+        '',                             # video_url
+        thumb_url,                      # thumb_url
+        post_type,                      # type
+        'Wordpress',                    # source
+        latitude,                       # latitude
+        longitude                       # longitude
+    )
+
+    return downloaded_values
+
+
+def process_wordpress(wordpress, modified_after=None, pool=None, modified_dates=None):
+
+    # refresh the location table export and load its post_id index
+    wordpress_location = wordpress_locations()
+
+    # Locations are looked up here so that the workers do not need the index
+    pages = ((pydict, [wordpress_location.get(post['id']) for post in pydict])
+             for pydict in fetch_wordpress_pages(wordpress, modified_after, modified_dates=modified_dates))
+
+    # Posts of a page are normalized while the next pages download
+    return normalize_pages(normalize_wordpress_post, pages, pool)
+
+
+def collect_tchop(published_after=None, pool=None):
+
+    # The Tchop stream is a single request with no date filter: always downloaded in full,
+    # and only parsed when it changed since the last run, or for a full resync (published_after None)
+
+    logging.info('### Data dump from Tchop')
+    print('Processing Tchop')
+    tchop_dump = get_data('https://tchop.io/api/stream/v1/stories', TCHOP_API_TOKEN,
+                          skip_unchanged=published_after is not None)
+
+    return process_tchop(tchop_dump, pool)
+
+
+def collect_youtube(published_after=None):
+
+    youtube_api = google_service_init(
+        'youtube',
+        'v3',
+        ['https://www.googleapis.com/auth/youtube'],
+        'YouTube-token.pickle',
+        'YouTube-credentials.json'
+    )
+
+    # Process Unicel Malawi channel
+    logging.info('### Get YouTube content')
+    print('Processing YouTube')
+    return process_youtube(youtube_api, YOUTUBE_CHANNEL_ID, published_after)
+
+
+def collect_blogger(updated_after=None, pool=None, modified_dates=None):
+
+    blogger_api = google_service_init(
+        'blogger',
+        'v3',
+        ['https://www.googleapis.com/auth/blogger'],
+        'Blogger-token.pickle',
+        'Blogger-credentials.json'
+    )
+
+    # Process Youth Out Loud - Malawi
+    logging.info('### Get Blogger content')
+    print('Processing Blogger')
+    return process_blogger(blogger_api, BLOGGER_BLOG_ID, updated_after, pool, modified_dates)
+
+
+def collect_wordpress(modified_after=None, pool=None, modified_dates=None):
+
+    logging.info('### Get Wordpress content')
+    print('Processing Wordpress')
+    return process_wordpress(WORDPRESS_API_POSTS, modified_after, pool, modified_dates)
+
+
+def load_sync_state(state_file=SYNC_STATE_FILE):
+
+    # High-water marks of the previous runs:
+    # {source: {'published_date': ..., 'modified_date': ..., 'last_sync': ..., 'full_sync': ...}}
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as state:
+            return json.load(state)
+
+    return {}
+
+
+def save_sync_state(sync_state, state_file=SYNC_STATE_FILE):
+
+    # Write to a temporary file first so that a crash cannot leave a truncated state
+    with open(state_file + '.tmp', 'w') as state:
+        json.dump(sync_state, state, indent=2, sort_keys=True)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def sync_start_date(sync_state, source):
+
+    # Date from which a source has to be read again, None for a full read
+    # Wordpress and Blogger are read from the last modification date they returned,
+    # the other sources from the last published date
+    source_state = sync_state.get(source, {})
+    mark = source_state.get('modified_date', source_state.get('published_date'))
+    if mark is None:
+        return None
+
+    # Edits of the sources that cannot be asked for their edited content are picked up by a full read
+    if source in SYNC_FULL_READ_DAYS:
+        full_sync = source_state.get('full_sync')
+        if full_sync is None or datetime.strptime(full_sync, '%Y-%m-%dT%H:%M:%S') < \
+                datetime.now() - timedelta(days=SYNC_FULL_READ_DAYS[source]):
+            return None
+
+    # Dates in the sheet are local to each source, go back a little to never miss a post
+    return datetime.strptime(mark, '%Y-%m-%dT%H:%M:%S') - timedelta(hours=SYNC_OVERLAP_HOURS)
+
+
+def update_sync_state(sync_state, source, published_date=None, modified_date=None, full_read=False):
+
+    # Move the marks of a source to the most recent published and modified dates it returned,
+    # a mark never goes back
+    source_state = dict(sync_state.get(source, {}))
+    for key, date in [('published_date', published_date), ('modified_date', modified_date)]:
+        if date is not None and date > source_state.get(key, ''):
+            source_state[key] = date
+
+    source_state['last_sync'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    if full_read:
+        source_state['full_sync'] = source_state['last_sync']
+
+    sync_state[source] = source_state
+
+
+class CollectorClock:
+
+    # Time a collector spent reading its source, not counting the time it waited for room in its queue
+    # while the sheet was busy with the sources before it
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.worked = 0.0
+        self.busy_since = None
+
+    def start(self):
+        with self.lock:
+            self.busy_since = time.monotonic()
+
+    def stop(self):
+        with self.lock:
+            self.worked = self.worked + time.monotonic() - self.busy_since
+            self.busy_since = None
+
+    def elapsed(self):
+        with self.lock:
+            if self.busy_since is None:
+                return self.worked
+            return self.worked + time.monotonic() - self.busy_since
+
+
+def run_collector(collector, source_queue, clock):
+
+    # Thread body: stream the batches of rows of one source into its queue
+    clock.start()
+    try:
+        for rows in collector():
+            clock.stop()
+            source_queue.put(('rows', rows))
+            clock.start()
+        clock.stop()
+        source_queue.put(('done', None))
+    except Exception as error:
+        source_queue.put(('error', error))
+
+
+def harvest_sources(collectors, completed_sources):
+
+    # Each collector runs in its own daemon thread and streams its rows through a bounded queue:
+    # the crawls overlap, memory stays flat, an error only loses the rest of its own source
+    # and a source stuck past its timeout cannot hold the process
+    # Sources that were read to the end are added to completed_sources
+    # The timeout of a source only counts the time its collector was reading it
+    queues = []
+    for source, collector in collectors:
+        source_queue = queue.Queue(maxsize=HARVEST_QUEUE_SIZE)
+        clock = CollectorClock()
+        thread = threading.Thread(target=run_collector, args=(collector, source_queue, clock), name=source,
+                                  daemon=True)
+        thread.start()
+        queues.append((source, source_queue, clock))
+
+    # Batches are given in the order of the collectors, whatever order the sources are read in
+    for source, source_queue, clock in queues:
+        timeout = SOURCE_TIMEOUTS.get(source, SOURCE_TIMEOUT)
+        counter_items = 0
+
+        while True:
+            try:
+                kind, payload = source_queue.get(timeout=max(0, timeout - clock.elapsed()))
+            except queue.Empty:
+                # The collector may have waited for room in its queue while this one was drained
+                if clock.elapsed() < timeout:
+                    continue
+                logging.error('%s harvesting timed out after %s seconds, rest of the source skipped'
+                              % (source, timeout))
+                print('%s harvesting timed out, rest of the source skipped' % source)
+                break
+
+            if kind == 'rows':
+                counter_items = counter_items + len(payload)
+                yield source, payload
+            elif kind == 'error':
+                logging.error('%s harvesting failed, rest of the source skipped' % source, exc_info=payload)
+                print('%s harvesting failed, rest of the source skipped:' % source, payload)
+                break
+            else:
+                logging.info('### %s: %s items harvested' % (source, counter_items))
+                completed_sources.append(source)
+                break
+
+        run_metrics().add_counters('Source harvesting', **{source: counter_items})
+
+
+def stream_rows(harvest, latest_dates, journal=None, completed_sources=(), replayed_sources=()):
+
+    # Flatten the harvested batches into rows, noting the most recent published date of each source
+    # With a journal, the batches of the sources read from the services are saved for a resumed run,
+    # and each source is marked harvested once it was read to the end
+    journaled_sources = set(replayed_sources)
+
+    def journal_completed_sources():
+        for source in completed_sources:
+            if source not in journaled_sources:
+                journal.complete_source(source)
+                journaled_sources.add(source)
+
+    for source, rows in harvest:
+        if journal is not None:
+            journal_completed_sources()
+            if source not in journaled_sources:
+                journal.record_rows(source, rows)
+
+        for content in rows:
+            if content.published_date > latest_dates.get(source, ''):
+                latest_dates[source] = content.published_date
+            yield content
+
+    if journal is not None:
+        journal_completed_sources()
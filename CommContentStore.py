@@ -0,0 +1,181 @@
+# CommContentStore.py
+#
+# Local content store in a SQLite file: the normalized rows of the Google Sheet
+# with their fingerprint, their position in the sheet and the fingerprint last
+# saved in the feature layer, so that the sheet does not have to be downloaded
+# at each run and only the rows that changed are sent to the layer
+#
+# python CommContentStore.py --source YouTube --since 2024-01-01
+
+# Standard libraries
+import sqlite3
+import argparse
+from datetime import datetime
+
+# Default settings, can be overridden in the variable file
+CONTENT_STORE_FILE = 'content.sqlite'  # Content store
+
+# Variable file
+from CommContentProcessingVariables import *
+
+# Content rows
+from CommContentRecord import ContentRecord, TEXT_FIELDS, LOCATION_FIELDS
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS content (
+    post_id TEXT PRIMARY KEY,
+    origin TEXT NOT NULL,
+    published_date TEXT NOT NULL,
+    post_url TEXT,
+    title TEXT,
+    content TEXT,
+    photo_url TEXT,
+    video_url TEXT,
+    thumb_url TEXT,
+    post_type TEXT,
+    source TEXT NOT NULL,
+    latitude REAL,
+    longitude REAL,
+    fingerprint TEXT NOT NULL,
+    sheet_position INTEGER,
+    layer_fingerprint TEXT,
+    updated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS content_source ON content (source);
+CREATE INDEX IF NOT EXISTS content_published_date ON content (published_date);
+CREATE TABLE IF NOT EXISTS store_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+RECORD_FIELDS = TEXT_FIELDS + LOCATION_FIELDS
+
+# Columns are listed in the order of the record fields, post_id among them
+UPSERT = 'INSERT INTO content (%s, fingerprint, updated) VALUES (%s) ON CONFLICT (post_id) DO UPDATE SET %s' % (
+    ', '.join(RECORD_FIELDS), ', '.join('?' * (len(RECORD_FIELDS) + 2)),
+    ', '.join('%s = excluded.%s' % (column, column)
+              for column in RECORD_FIELDS + ('fingerprint', 'updated') if column != 'post_id'))
+
+
+def now_text():
+    return datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def record_from_row(row):
+    # row: the record fields in RECORD_FIELDS order
+    return ContentRecord(*row[:len(TEXT_FIELDS)], latitude=row[-2], longitude=row[-1])
+
+
+class ContentStore:
+
+    # Content rows keyed by post_id, opened from the main thread
+    # sheet_position is the position of the row in the sheet, NULL for rows no longer in the sheet
+    # layer_fingerprint is the fingerprint of the row when it was last found or saved in the feature layer
+
+    def __init__(self, store_file=CONTENT_STORE_FILE):
+        self.connection = sqlite3.connect(store_file)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    def state(self, key):
+        row = self.connection.execute('SELECT value FROM store_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_state(self, key, value):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO store_state VALUES (?, ?)', (key, value))
+
+    def sheet_in_sync(self):
+        # Whether the rows of the store are the rows of the sheet, in the same order
+        return self.state('sheet_in_sync') == '1'
+
+    def begin_sheet_changes(self):
+        # Called before the sheet is changed: if the run stops before save_sheet(),
+        # the next run reads the whole sheet again
+        self.set_state('sheet_in_sync', '0')
+
+    def sheet_records(self):
+        # Rows of the sheet, in sheet order
+        return [record_from_row(row) for row in self.connection.execute(
+            'SELECT %s FROM content WHERE sheet_position IS NOT NULL ORDER BY sheet_position'
+            % ', '.join(RECORD_FIELDS))]
+
+    def save_sheet(self, sheet_index, post_ids=None):
+
+        # Save the rows of post_ids and the position of every row once the sheet is up to date
+        # post_ids None: the whole sheet was read, the store is replaced by its rows
+        # Fingerprints saved in the layer are kept: the rows that changed become pending for the layer
+        updated = now_text()
+        if post_ids is None:
+            post_ids = list(sheet_index.positions)
+
+        with self.connection:
+            self.connection.executemany(UPSERT, [
+                tuple(getattr(record, field) for field in RECORD_FIELDS) + (record.fingerprint, updated)
+                for record in (sheet_index.get(post_id) for post_id in post_ids if post_id in sheet_index)])
+
+            # Only the positions that moved are written, e.g. after rows were inserted or sorted
+            # If a post_id is duplicated in the sheet, its first row is kept: the store then never
+            # matches the sheet and the whole sheet is read at each run, as before the store
+            stored_positions = dict(self.connection.execute('SELECT post_id, sheet_position FROM content'))
+            self.connection.executemany('UPDATE content SET sheet_position = ? WHERE post_id = ?', [
+                (position, post_id) for post_id, position in sheet_index.positions.items()
+                if stored_positions.get(post_id) != position])
+            self.connection.executemany('UPDATE content SET sheet_position = NULL WHERE post_id = ?', [
+                (post_id,) for post_id, position in stored_positions.items()
+                if position is not None and post_id not in sheet_index])
+
+            self.connection.execute('INSERT OR REPLACE INTO store_state VALUES (?, ?)', ('sheet_in_sync', '1'))
+
+    def layer_pending(self):
+        # post_ids of the sheet rows that differ from what was last saved in the feature layer
+        return set(row[0] for row in self.connection.execute(
+            'SELECT post_id FROM content WHERE sheet_position IS NOT NULL '
+            'AND (layer_fingerprint IS NULL OR layer_fingerprint != fingerprint)'))
+
+    def mark_layer_synced(self, records):
+        # Records found equal in the feature layer or saved in it
+        with self.connection:
+            self.connection.executemany('UPDATE content SET layer_fingerprint = ? WHERE post_id = ?',
+                                        [(record.fingerprint, record.post_id) for record in records])
+
+    def layer_verified(self):
+        # Whether the whole layer was compared with the store at least once
+        return self.state('layer_verified') is not None
+
+    def set_layer_verified(self):
+        self.set_state('layer_verified', now_text())
+
+    def query(self, source=None, published_after=None):
+        # Rows of a source and/or published after a date, most recent first
+        conditions = []
+        parameters = []
+        if source is not None:
+            conditions.append('source = ?')
+            parameters.append(source)
+        if published_after is not None:
+            conditions.append('published_date >= ?')
+            parameters.append(published_after)
+
+        return [record_from_row(row) for row in self.connection.execute(
+            'SELECT %s FROM content%s ORDER BY published_date DESC'
+            % (', '.join(RECORD_FIELDS), ' WHERE ' + ' AND '.join(conditions) if conditions else ''), parameters)]
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Query the content store')
+    parser.add_argument('--source', help='only the content of a source, e.g. YouTube')
+    parser.add_argument('--since', help='only the content published since a date, e.g. 2024-01-01')
+    args = parser.parse_args()
+
+    store = ContentStore()
+    for record in store.query(args.source, args.since):
+        print('%s  %-9s  %-14s  %s' % (record.published_date, record.source, record.post_id, record.title))
+    store.close()